@@ -1,39 +1,273 @@
 import asyncio
 import os
-import json
+import time
+import unicodedata
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
-from typing import List, Optional
-from playwright.async_api import async_playwright, Page
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+import orjson
+from playwright.async_api import async_playwright, expect, BrowserContext, Locator, Page, Playwright, Route, TimeoutError as PlaywrightTimeoutError
+
+# 持久化浏览器 profile 的根目录
+PROFILE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".pw_profiles")
+SCREENSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "publish_screenshots")
+
+PUBLISH_URL = "https://creator.xiaohongshu.com/publish/publish"
+COOKIE_FILE = "xhs_cookies.json"
+# Cookie 保存后的这段时间内直接信任，跳过登录校验页面的跳转（小红书会话有效期远长于此）
+COOKIE_TRUST_SECONDS = 6 * 3600
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# Chromium 启动参数：关闭与发布无关的后台服务，减少渲染进程的额外开销
+CHROME_ARGS = (
+    '--disable-blink-features=AutomationControlled',
+    '--disable-extensions',
+    '--disable-component-extensions-with-background-pages',
+    '--disable-default-apps',
+    '--mute-audio',
+    '--no-default-browser-check',
+    '--no-first-run',
+    '--disable-background-networking',
+    '--disable-background-timer-throttling',
+    '--disable-client-side-phishing-detection',
+    '--disable-popup-blocking',
+    '--disable-prompt-on-repost',
+    '--disable-sync',
+    '--metrics-recording-only',
+    '--no-experiments',
+    '--safebrowsing-disable-auto-update',
+    '--password-store=basic',
+    '--use-mock-keychain',
+    '--disable-features=Translate,BackForwardCache,OptimizationHints,IsolateOrigins,site-per-process',
+    '--disable-renderer-backgrounding',
+    '--disable-ipc-flooding-protection',
+)
+
+# 标题显示宽度上限：中文/emoji 记 2，半角字符记 1，相当于 18 个中文字符
+TITLE_MAX_WIDTH = 36
+
+# 页面操作的默认超时，以及“元素是否存在”这类短探测的超时（毫秒）
+DEFAULT_TIMEOUT = 15000
+PROBE_TIMEOUT = 100
+
+# 页面就绪标志：用事件驱动的等待代替固定时长的 sleep
+FILE_INPUT = 'input[type="file"]'
+# 切换上传类型后，等新标签页自己的上传入口渲染出来（发布页一打开就有的 FILE_INPUT 不能说明切换已完成）
+VIDEO_FILE_INPUT = 'input[type="file"][accept*="video"]'
+IMAGE_FILE_INPUT = 'input[type="file"]:not([accept*="video"])'
+LOGIN_MARKER = 'text=数据总览'
+PUBLISH_NOTE_MARKER = 'text=发布笔记'
+UPLOAD_DONE = '[class*="preview"] img, .upload-success'
+VIDEO_UPLOAD_DONE = 'text="重新上传"'
+COVER_DONE = '[class*="cover"] img'
+TITLE_READY = 'input.c-input_inner'
+PUBLISH_DONE_TOAST = 'text=发布成功'
+DRAFT_DONE_TOAST = 'text=/暂存成功|保存成功/'
+
+# 一次性列出页面上所有 file input 及其 accept 属性和所在区域的 class，按用途而非顺序选择上传入口
+FILE_INPUTS_JS = """() => [...document.querySelectorAll('input[type=file]')].map((el, index) => {
+    const scope = el.closest('[class*="cover"],[class*="Cover"],[class*="video"],[class*="image"]');
+    return {index, accept: el.accept || '', scope: scope ? (scope.getAttribute('class') || '') : ''};
+})"""
+
+# 聚焦正文编辑器（选择器命中外层容器时取其中的 contenteditable 节点）并以“粘贴”的方式整段写入文本；
+# 返回是否确实写入了内容，找不到可编辑节点或编辑器拒绝 execCommand 时返回 false，由调用方改用键盘输入
+INSERT_TEXT_JS = """(el, text) => {
+    const target = el.isContentEditable ? el : el.querySelector('[contenteditable="true"]');
+    if (!target) return false;
+    target.focus();
+    const before = target.textContent.length;
+    return document.execCommand('insertText', false, text) && target.textContent.length > before;
+}"""
+
+# 发布流程只依赖编辑器 DOM，这些资源类型和统计上报请求直接拦截
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+BLOCKED_HOSTS = ("google-analytics", "sentry", "hm.baidu")
+
+# 标题 / 正文输入框的候选选择器，按优先级排列
+TITLE_SELECTORS = [
+    'input.c-input_inner',
+    'input[placeholder*="标题"]',
+    '.title-input input'
+]
+CONTENT_SELECTORS = [
+    '#post-textarea',
+    '.editor-content',
+    '[contenteditable="true"]'
+]
+
+
+@lru_cache(maxsize=4096)
+def char_width(ch: str) -> int:
+    """字符显示宽度：全角/宽字符（中文、大部分 emoji）记 2，其余记 1"""
+    return 2 if unicodedata.east_asian_width(ch) in ("F", "W") else 1
+
+
+def truncate_title(title: str, max_width: int = TITLE_MAX_WIDTH) -> str:
+    """按显示宽度截断标题，英文等半角字符不会被过度截断，emoji 也不会超出限制"""
+    width = 0
+    for i, ch in enumerate(title):
+        width += char_width(ch)
+        if width > max_width:
+            return title[:i]
+    return title
+
+
+async def wait_for_marker(page: Page, selector: str, timeout: float, state: str = "visible") -> bool:
+    """等待页面出现指定元素，超时返回 False 而不是抛异常"""
+    try:
+        await page.wait_for_selector(selector, state=state, timeout=timeout)
+        return True
+    except PlaywrightTimeoutError:
+        return False
+
+
+async def which_exist(page: Page, selectors: List[str]) -> List[bool]:
+    """用一次 evaluate 批量探测多个 CSS 选择器，返回与 selectors 一一对应的命中结果"""
+    return await page.evaluate("sels => sels.map(s => !!document.querySelector(s))", selectors)
+
+
+async def find_first_existing(page: Page, selectors: List[str]) -> Optional[str]:
+    """返回第一个在页面上存在的选择器，全部未命中时返回 None"""
+    hits = await which_exist(page, selectors)
+    return next((selector for selector, hit in zip(selectors, hits) if hit), None)
+
+
+def login_marker(page: Page) -> Locator:
+    """登录后才会出现的页面元素（“数据总览”或“发布笔记”），用 or_ 合成一个 Locator 一次探测"""
+    return page.locator(LOGIN_MARKER).or_(page.locator(PUBLISH_NOTE_MARKER))
+
+
+async def wait_for_first_existing(page: Page, selectors: List[str], timeout: float) -> Optional[str]:
+    """等待任一候选选择器出现，返回其中优先级最高的命中项，超时返回 None"""
+    if not await wait_for_marker(page, ", ".join(selectors), timeout=timeout, state="attached"):
+        return None
+    return await find_first_existing(page, selectors)
+
+
+async def find_editor_inputs(page: Page, timeout: float = 30000):
+    """并发查找标题和正文输入框，返回 (title_selector, content_selector)"""
+    return await asyncio.gather(
+        wait_for_first_existing(page, TITLE_SELECTORS, timeout),
+        wait_for_first_existing(page, CONTENT_SELECTORS, timeout),
+    )
+
+
+async def block_heavy_resources(route: Route):
+    """路由拦截器：丢弃图片/字体/媒体和统计上报请求，其余请求（包括上传接口）照常放行"""
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or any(host in request.url for host in BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def find_file_input(page: Page, kind: str, exclude: Optional[int] = None) -> Optional[int]:
+    """按用途查找 file input，返回其在页面所有 file input 中的序号，找不到时返回 None
+
+    kind 取值：
+        video: 视频上传入口，未能识别时退回第一个 input
+        image: 图文上传入口，未能识别时退回第一个不只接受视频的 input，没有则返回 None
+        cover: 封面图上传入口，未能识别时退回除 exclude 以外第一个接受图片的 input
+    """
+    inputs = [info for info in await page.evaluate(FILE_INPUTS_JS) if info["index"] != exclude]
+    if not inputs:
+        return None
+
+    def accepts(info: Dict[str, Any], media: str) -> bool:
+        return not info["accept"] or media in info["accept"]
+
+    if kind == "cover":
+        matched = [info for info in inputs if "cover" in info["scope"].lower() and accepts(info, "image")]
+        fallback = [info for info in inputs if accepts(info, "image") and "video" not in info["accept"]]
+    elif kind == "image":
+        matched = [info for info in inputs if "image" in info["accept"] or "image" in info["scope"].lower()]
+        # 只接受视频的入口不能用来传图片
+        fallback = [info for info in inputs if "video" not in info["accept"]]
+    else:
+        matched = [info for info in inputs if kind in info["accept"] or kind in info["scope"].lower()]
+        fallback = inputs
+    candidates = matched or fallback
+    return candidates[0]["index"] if candidates else None
+
+
+async def probe(locator: Locator, visible: bool = True, timeout: float = PROBE_TIMEOUT) -> bool:
+    """短超时探测元素是否可见（或仅存在于 DOM 中），命中后可直接对同一个 Locator 操作"""
+    try:
+        if visible:
+            await expect(locator.first).to_be_visible(timeout=timeout)
+        else:
+            await expect(locator.first).to_be_attached(timeout=timeout)
+        return True
+    except AssertionError:
+        return False
+
+
+def _write_cookie_file(cookie_file: str, data: bytes):
+    with open(cookie_file, 'wb') as f:
+        f.write(data)
+
+
+def _read_cookie_file(cookie_file: str) -> Optional[bytes]:
+    if not os.path.exists(cookie_file):
+        return None
+    with open(cookie_file, 'rb') as f:
+        return f.read()
 
 
 async def save_cookies(page: Page, cookie_file: str):
     cookies = await page.context.cookies()
-    with open(cookie_file, 'w', encoding='utf-8') as f:
-        json.dump(cookies, f)
+    # 文件读写放到线程中执行，避免阻塞事件循环
+    await asyncio.to_thread(_write_cookie_file, cookie_file, orjson.dumps(cookies))
 
 
 async def load_cookies(page: Page, cookie_file: str) -> bool:
-    if os.path.exists(cookie_file):
-        with open(cookie_file, 'r', encoding='utf-8') as f:
-            cookies = json.load(f)
-            await page.context.add_cookies(cookies)
-        return True
-    return False
+    data = await asyncio.to_thread(_read_cookie_file, cookie_file)
+    if data is None:
+        return False
+    await page.context.add_cookies(orjson.loads(data))
+    return True
 
 
-async def login_xiaohongshu(page: Page) -> bool:
-    """处理小红书登录"""
-    cookie_file = "xhs_cookies.json"
+def cookies_are_fresh(cookie_file: str) -> bool:
+    """Cookie 文件存在且保存时间在信任期内"""
+    try:
+        return time.time() - os.path.getmtime(cookie_file) < COOKIE_TRUST_SECONDS
+    except OSError:
+        return False
+
+
+class LoginRequiredError(RuntimeError):
+    """无头模式下 Cookie 失效，需要切换到有头浏览器扫码登录"""
+
+
+async def login_xiaohongshu(page: Page, trust_recent_cookies: bool = True, allow_qr_login: bool = True) -> bool:
+    """处理小红书登录
+
+    trust_recent_cookies 为 True 且 Cookie 较新时，只加载 Cookie 不做跳转校验，
+    由后续打开发布页时顺带确认登录态。
+    allow_qr_login 为 False 时（无头模式下用户看不到二维码），Cookie 无效直接返回 False。
+    """
+    cookie_file = COOKIE_FILE
+
+    if trust_recent_cookies and cookies_are_fresh(cookie_file) and await load_cookies(page, cookie_file):
+        print("Cookie 仍在有效期内，跳过登录校验")
+        return True
     
     # 尝试加载 Cookie
     if await load_cookies(page, cookie_file):
         await page.goto("https://creator.xiaohongshu.com/creator/home")
-        await page.wait_for_timeout(2000)
         # 检查是否成功登录（寻找某个登录后的元素）
-        if "creator/home" in page.url or await page.locator("text=数据总览").count() > 0:
+        has_marker = await probe(login_marker(page), timeout=5000)
+        if "creator/home" in page.url or has_marker:
             print("使用 Cookie 登录成功！")
             return True
             
+    if not allow_qr_login:
+        return False
+
     # 如果 Cookie 无效，走扫码登录流程
     print("需要扫码登录小红书，请在弹出的浏览器中进行操作...")
     await page.goto("https://creator.xiaohongshu.com/login")
@@ -48,21 +282,26 @@ async def login_xiaohongshu(page: Page) -> bool:
     except Exception as e:
         print(f"登录超时或失败: {e}")
         # 如果是因为已经登录，只是 URL 匹配不上，我们做一次额外检查
-        if await page.locator("text=数据总览").count() > 0 or await page.locator("text=发布笔记").count() > 0:
+        if await probe(login_marker(page)):
             print("发现登录成功特征，强制视为登录成功")
             await save_cookies(page, cookie_file)
             return True
         return False
 
 
+@lru_cache(maxsize=1)
+def screenshot_dir() -> str:
+    """截图目录只在第一次截图时创建，之后直接复用"""
+    os.makedirs(SCREENSHOT_DIR, exist_ok=True)
+    return SCREENSHOT_DIR
+
+
 async def take_screenshot(page: Page, label: str = "result") -> str:
     """截图并保存到 publish_screenshots 目录，返回截图文件路径"""
-    screenshot_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "publish_screenshots")
-    os.makedirs(screenshot_dir, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    screenshot_path = os.path.join(screenshot_dir, f"{label}_{timestamp}.png")
+    screenshot_path = f"{screenshot_dir()}{os.sep}{label}_{datetime.now():%Y%m%d_%H%M%S}.jpg"
     try:
-        await page.screenshot(path=screenshot_path, full_page=False)
+        # JPEG 体积远小于 PNG，留存确认用的截图足够清晰
+        await page.screenshot(path=screenshot_path, full_page=False, type="jpeg", quality=70)
         print(f"截图已保存: {screenshot_path}")
         return screenshot_path
     except Exception as e:
@@ -70,6 +309,90 @@ async def take_screenshot(page: Page, label: str = "result") -> str:
         return ""
 
 
+class BrowserPool:
+    """按 profile 复用持久化的浏览器上下文，避免每次发布都冷启动 Chromium。
+
+    使用 launch_persistent_context，Cookie 与缓存落盘在 .pw_profiles/<profile> 下，
+    跨进程、跨次发布都能直接复用登录态。
+    通过 lease 借用上下文，池中记录每个 profile 正在使用的发布数，切换有头/无头模式时不会关掉别人正在用的浏览器。
+    """
+
+    def __init__(self):
+        self._playwright: Optional[Playwright] = None
+        self._contexts: Dict[str, BrowserContext] = {}
+        self._headless: Dict[str, bool] = {}
+        self._users: Dict[str, int] = {}
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def lease(self, profile: str = "default", headless: bool = False):
+        """借用 profile 对应的浏览器上下文，退出时归还"""
+        context = await self.acquire(profile, headless)
+        try:
+            yield context
+        finally:
+            await self.release(profile)
+
+    async def acquire(self, profile: str = "default", headless: bool = False) -> BrowserContext:
+        """获取 profile 对应的浏览器上下文，用完必须调用 release（推荐直接用 lease）。
+
+        同一 profile 目录不能被两个浏览器同时占用，所以请求的有头/无头模式与池中不一致时，
+        先等该 profile 上其他发布全部归还，再关闭后按新模式重新启动。"""
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: profile not in self._contexts
+                or self._headless.get(profile) == headless
+                or self._users.get(profile, 0) == 0
+            )
+            context = self._contexts.get(profile)
+            if context is not None and self._headless.get(profile) != headless:
+                await context.close()
+                context = None
+            if context is None:
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
+                # 需要扫码或人工操作时使用有头模式，方便观察和处理可能的滑块验证码；
+                # 其余情况使用新版无头模式（channel="chromium"），省去窗口和合成器的开销
+                context = await self._playwright.chromium.launch_persistent_context(
+                    user_data_dir=os.path.join(PROFILE_ROOT, profile),
+                    channel="chromium",
+                    headless=headless,
+                    user_agent=USER_AGENT,
+                    args=list(CHROME_ARGS)
+                )
+                # 用户手动关闭浏览器窗口时，从池中移除，下次重新启动
+                context.on("close", lambda closed: self._forget(profile, closed))
+                self._contexts[profile] = context
+                self._headless[profile] = headless
+            self._users[profile] = self._users.get(profile, 0) + 1
+            return context
+
+    async def release(self, profile: str = "default"):
+        """归还 acquire 借出的上下文；等待切换模式的发布会被唤醒"""
+        async with self._cond:
+            self._users[profile] = max(self._users.get(profile, 0) - 1, 0)
+            self._cond.notify_all()
+
+    def _forget(self, profile: str, context: BrowserContext):
+        # 只移除已关闭的那个上下文，避免误删切换模式后新启动的上下文
+        if self._contexts.get(profile) is context:
+            del self._contexts[profile]
+
+    async def close(self):
+        """关闭池中所有浏览器并停止 Playwright 驱动进程"""
+        async with self._cond, AsyncExitStack() as stack:
+            # 回调按注册的逆序执行：先关闭各个浏览器，最后停止驱动；其中某一步失败也不影响其余清理
+            if self._playwright is not None:
+                stack.push_async_callback(self._playwright.stop)
+                self._playwright = None
+            for context in self._contexts.values():
+                stack.push_async_callback(context.close)
+            self._contexts.clear()
+
+
+browser_pool = BrowserPool()
+
+
 async def publish_with_playwright(title: str, content: str, image_paths: List[str] = [], video_path: Optional[str] = None, cover_image_paths: List[str] = [], save_draft: bool = False) -> str:
     """使用 Playwright 模拟浏览器操作发布笔记，发布后自动截图留存。
     
@@ -82,240 +405,247 @@ async def publish_with_playwright(title: str, content: str, image_paths: List[st
     """
     if not image_paths and not video_path:
         raise ValueError("没有需要上传的图片或视频素材")
-        
-    async with async_playwright() as p:
-        # 使用有头模式启动，方便观察和处理可能的滑块验证码
-        browser = await p.chromium.launch(
-            headless=False, 
-            args=[
-                '--disable-blink-features=AutomationControlled',
-                '--disable-extensions',
-                '--disable-component-extensions-with-background-pages',
-                '--disable-default-apps',
-                '--mute-audio',
-                '--no-default-browser-check',
-                '--no-first-run',
-                '--disable-background-networking',
-                '--disable-background-timer-throttling',
-                '--disable-client-side-phishing-detection',
-                '--disable-popup-blocking',
-                '--disable-prompt-on-repost',
-                '--disable-sync',
-                '--metrics-recording-only',
-                '--no-experiments',
-                '--safebrowsing-disable-auto-update',
-                '--password-store=basic',
-                '--use-mock-keychain'
-            ]
-        )
-        context = await browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        )
+
+    # 已有 Cookie 且发布后无需人工操作时用无头模式；扫码登录和暂存草稿需要可见窗口
+    headless = not save_draft and os.path.exists(COOKIE_FILE)
+    try:
+        return await _publish_in_new_page(headless, title, content, image_paths, video_path, cover_image_paths, save_draft)
+    except LoginRequiredError:
+        print("Cookie 已失效，切换到有头浏览器进行扫码登录...")
+        return await _publish_in_new_page(False, title, content, image_paths, video_path, cover_image_paths, save_draft)
+
+
+async def _publish_in_new_page(headless: bool, title: str, content: str, image_paths: List[str], video_path: Optional[str], cover_image_paths: List[str], save_draft: bool) -> str:
+    async with AsyncExitStack() as stack:
+        # 先登记归还浏览器，再登记关闭页面：退出时先关页面，再归还
+        context = await stack.enter_async_context(browser_pool.lease(headless=headless))
         page = await context.new_page()
-        screenshot_path = ""
+        # 只关闭本次使用的标签页，浏览器留在池中供下次发布复用
+        stack.push_async_callback(close_page_quietly, page)
+        page.set_default_timeout(DEFAULT_TIMEOUT)
+        return await _publish_on_page(page, title, content, image_paths, video_path, cover_image_paths, save_draft, interactive=not headless)
+
+
+async def close_page_quietly(page: Page):
+    """关闭标签页；浏览器已断开等原因导致关闭失败时只打印日志，不掩盖发布流程中的原始异常"""
+    try:
+        await page.close()
+    except Exception as e:
+        print(f"关闭页面失败: {e}")
+
+
+async def publish_many(items: List[Dict[str, Any]], concurrency: int = 3) -> List[Any]:
+    """批量发布多篇笔记：共享同一个浏览器，用信号量限制同时打开的标签页数量。
+
+    Args:
+        items:       每一项为 publish_with_playwright 的关键字参数字典
+        concurrency: 同时进行的发布数量
+
+    Returns:
+        与 items 顺序一致的结果列表，失败的项为对应的异常对象
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def publish_one(item: Dict[str, Any]) -> str:
+        async with semaphore:
+            return await publish_with_playwright(**item)
+
+    return await asyncio.gather(*(publish_one(item) for item in items), return_exceptions=True)
+
+
+async def ensure_login(page: Page, trust_recent_cookies: bool, interactive: bool):
+    """登录失败时截图并抛出异常；无头模式下抛出 LoginRequiredError 以便切换到有头浏览器重试"""
+    if await login_xiaohongshu(page, trust_recent_cookies=trust_recent_cookies, allow_qr_login=interactive):
+        return
+    await take_screenshot(page, "login_failed")
+    if not interactive:
+        raise LoginRequiredError("Cookie 已失效，需要扫码登录。")
+    raise RuntimeError("登录失败，无法发布。")
+
+
+async def _publish_on_page(page: Page, title: str, content: str, image_paths: List[str], video_path: Optional[str], cover_image_paths: List[str], save_draft: bool, interactive: bool = True) -> str:
+    """在给定标签页上执行完整的登录、上传、填写与发布流程"""
+    screenshot_path = ""
+    # 标题/正文输入框的查找与素材上传并行进行，上传完成时输入框通常也已就绪
+    editor_task: Optional[asyncio.Future] = None
+    
+    try:
+        # 1. 登录
+        await ensure_login(page, trust_recent_cookies=True, interactive=interactive)
+            
+        # 2. 进入发布页面
+        # 登录完成后再开启资源拦截，避免扫码登录页的二维码图片被拦掉
+        await page.route("**/*", block_heavy_resources)
+        await page.goto(PUBLISH_URL)
+        if not await wait_for_marker(page, FILE_INPUT, timeout=15000, state="attached") and "login" in page.url:
+            # 未经校验直接使用的 Cookie 已失效，被重定向到登录页：关闭拦截后走完整登录流程
+            await page.unroute("**/*", block_heavy_resources)
+            await ensure_login(page, trust_recent_cookies=False, interactive=interactive)
+            await page.route("**/*", block_heavy_resources)
+            await page.goto(PUBLISH_URL)
+            await wait_for_marker(page, FILE_INPUT, timeout=15000, state="attached")
+        if "login" not in page.url:
+            # 发布页已以登录状态打开：重新保存 Cookie（同时刷新文件时间），登录态有效期间一直走免校验的快速路径
+            await save_cookies(page, COOKIE_FILE)
+        # 上传入口的 Locator 只创建一次，视频、封面和图片上传共用
+        file_input = page.locator(FILE_INPUT)
         
-        try:
-            # 1. 登录
-            if not await login_xiaohongshu(page):
-                await take_screenshot(page, "login_failed")
-                await browser.close()
-                raise RuntimeError("登录失败，无法发布。")
-                
-            # 2. 进入发布页面
-            await page.goto("https://creator.xiaohongshu.com/publish/publish")
-            await page.wait_for_timeout(3000)
+        # 3. 选择发布类型并上传文件
+        if video_path:
+            print(f"正在准备上传视频: {video_path}")
             
-            # 3. 选择发布类型并上传文件
-            if video_path:
-                print(f"正在准备上传视频: {video_path}")
+            # 点击上传视频选项卡 (如果存在)
+            tab_video = page.locator('div.tab >> text="上传视频"')
+            if await probe(tab_video):
+                await tab_video.first.click()
+                await wait_for_marker(page, VIDEO_FILE_INPUT, timeout=5000, state="attached")
                 
-                # 点击上传视频选项卡 (如果存在)
-                tab_video = page.locator('div.tab >> text="上传视频"')
-                if await tab_video.count() > 0:
-                    await tab_video.click()
-                    await page.wait_for_timeout(1000)
-                    
-                file_input = page.locator('input[type="file"]')
-                await file_input.first.set_input_files(video_path)
-                # 等待视频上传完成
-                print("等待视频上传...")
-                
-                # 轮询检查上传进度或者等待一个较长的固定时间
-                # 小红书上传视频时，界面上会有类似“重新上传”的按钮出现，表示上传完成
-                # 我们这里加长默认等待时间，最大等待 2 分钟 (120秒)
-                try:
-                    await page.wait_for_selector('text="重新上传"', timeout=120000)
-                    print("✅ 视频上传成功。")
-                    await page.wait_for_timeout(2000) # 缓冲一下
-                except Exception:
-                    print("⚠️ 等待视频上传完成标志超时，可能还在上传或页面变化。再额外等待 15 秒...")
-                    await page.wait_for_timeout(15000)
-
-                # ── 封面图上传（方案C）────────────────────────────────────────
-                if cover_image_paths:
-                    print(f"尝试上传 {len(cover_image_paths)} 张封面图...")
-                    cover_uploaded = False
-
-                    # 优先策略：寻找专用封面图上传区域（class 含 cover 的 file input）
-                    cover_selectors = [
-                        '[class*="cover"] input[type="file"]',
-                        '[class*="Cover"] input[type="file"]',
-                        '.cover-image input[type="file"]',
-                        '.upload-cover input[type="file"]',
-                    ]
-                    for selector in cover_selectors:
-                        cover_input = page.locator(selector)
-                        if await cover_input.count() > 0:
-                            await cover_input.first.set_input_files(cover_image_paths[0])
-                            print(f"✅ 使用选择器 [{selector}] 成功上传封面图")
-                            cover_uploaded = True
-                            await page.wait_for_timeout(2000)
-                            break
-
-                    # 备选策略：页面上第二个 file input（第一个已被视频占用）
-                    if not cover_uploaded:
-                        all_inputs = page.locator('input[type="file"]')
-                        input_count = await all_inputs.count()
-                        if input_count >= 2:
-                            await all_inputs.nth(1).set_input_files(cover_image_paths[0])
-                            print("✅ 通过第二个 file input 成功上传封面图")
-                            cover_uploaded = True
-                            await page.wait_for_timeout(2000)
-
-                    if not cover_uploaded:
-                        print("⚠️ 未找到封面图上传入口，跳过封面图（不影响视频发布）")
-                # ─────────────────────────────────────────────────────────────
-            elif image_paths:
-                print(f"正在准备上传图片: {len(image_paths)} 张")
-                # 小红书默认打开"上传视频"tab，必须先点击"上传图文"选项卡
-                tab_image = page.locator('div.tab >> text="上传图文"')
-                if await tab_image.count() > 0:
-                    # 使用 evaluate 执行 javascript 点击，避免 playwright 的可见性检查
-                    await tab_image.first.evaluate("el => el.click()")
-                    print("通过 JS 点击切换到'上传图文'标签页")
-                    await page.wait_for_timeout(1000)
+            video_index = await find_file_input(page, "video")
+            if video_index is None:
+                raise RuntimeError("未找到上传视频的 input 元素")
+
+            # 等待视频上传完成
+            print("等待视频上传...")
+            await file_input.nth(video_index).set_input_files(video_path)
+            editor_task = asyncio.ensure_future(find_editor_inputs(page))
+
+            # 小红书上传视频完成后，界面上会出现“重新上传”按钮，出现即继续，最长等待 2 分钟
+            if await wait_for_marker(page, VIDEO_UPLOAD_DONE, timeout=120000):
+                print("✅ 视频上传成功。")
+            else:
+                print("⚠️ 等待视频上传完成标志超时，可能还在上传或页面变化。等待标题输入框就绪...")
+                await wait_for_marker(page, TITLE_READY, timeout=15000)
+
+            # ── 封面图上传（方案C）────────────────────────────────────────
+            if cover_image_paths:
+                print(f"尝试上传 {len(cover_image_paths)} 张封面图...")
+                # 优先选择封面区域内接受图片的 input，其次是视频入口以外接受图片的 input
+                cover_index = await find_file_input(page, "cover", exclude=video_index)
+                if cover_index is not None:
+                    await file_input.nth(cover_index).set_input_files(cover_image_paths[0])
+                    print(f"✅ 通过第 {cover_index + 1} 个 file input 成功上传封面图")
+                    await wait_for_marker(page, COVER_DONE, timeout=10000)
                 else:
-                    # 备选选择器
-                    tab_image_alt = page.locator('text="上传图文"')
-                    if await tab_image_alt.count() > 0:
-                        await tab_image_alt.first.evaluate("el => el.click()")
-                        print("通过 JS 备选选择器点击切换到'上传图文'标签页")
-                        await page.wait_for_timeout(1000)
-                    else:
-                        print("未找到'上传图文'标签，可能当前页面已经是图文模式")
-                
-                file_input = page.locator('input[type="file"]')
-                if await file_input.count() > 0:
-                    await file_input.first.set_input_files(image_paths)
-                    print("等待图片上传...")
-                    await page.wait_for_timeout(5000)
+                    print("⚠️ 未找到封面图上传入口，跳过封面图（不影响视频发布）")
+            # ─────────────────────────────────────────────────────────────
+        elif image_paths:
+            print(f"正在准备上传图片: {len(image_paths)} 张")
+            # 小红书默认打开"上传视频"tab，必须先点击"上传图文"选项卡
+            tab_image = page.locator('div.tab >> text="上传图文"')
+            # 标签可能不可见，只要求存在于 DOM 中
+            if await probe(tab_image, visible=False):
+                # 使用 evaluate 执行 javascript 点击，避免 playwright 的可见性检查
+                await tab_image.first.evaluate("el => el.click()")
+                print("通过 JS 点击切换到'上传图文'标签页")
+                await wait_for_marker(page, IMAGE_FILE_INPUT, timeout=5000, state="attached")
+            else:
+                # 备选选择器
+                tab_image_alt = page.locator('text="上传图文"')
+                if await probe(tab_image_alt, visible=False):
+                    await tab_image_alt.first.evaluate("el => el.click()")
+                    print("通过 JS 备选选择器点击切换到'上传图文'标签页")
+                    await wait_for_marker(page, IMAGE_FILE_INPUT, timeout=5000, state="attached")
                 else:
-                    raise RuntimeError("未找到上传图文的 input 元素")
-
-            # 4. 填写标题和内容
-            print("填写标题和内容...")
-            await page.wait_for_timeout(3000)
-            
-            # 强制截断标题，保守切到前 18 个字符（小红书标题最多 20 字）
-            safe_title = title[:18] if len(title) > 18 else title
-            print(f"原标题: {title} | 截断后标题: {safe_title}")
-            
-            # 标题输入框: 尝试多种选择器
-            print("查找标题输入框...")
-            title_selectors = [
-                'input.c-input_inner',
-                'input[placeholder*="标题"]',
-                '.title-input input'
-            ]
-            
-            title_filled = False
-            for selector in title_selectors:
-                if await page.locator(selector).count() > 0:
-                    await page.locator(selector).first.fill(safe_title)
-                    print(f"使用选择器 {selector} 成功填写标题")
-                    title_filled = True
-                    break
-                    
-            if not title_filled:
-                print("警告：未找到合适的标题输入框！")
-
-            # 正文输入框
-            print("查找正文输入框...")
-            content_selectors = [
-                '#post-textarea',
-                '.editor-content',
-                '[contenteditable="true"]'
-            ]
+                    print("未找到'上传图文'标签，可能当前页面已经是图文模式")
             
-            content_filled = False
-            for selector in content_selectors:
-                if await page.locator(selector).count() > 0:
-                    await page.locator(selector).first.click()
-                    await page.wait_for_timeout(500)
-                    await page.keyboard.insert_text(content)
-                    await page.keyboard.press("Enter")
-                    print(f"使用选择器 {selector} 成功填写正文并追加换行")
-                    content_filled = True
-                    break
-                    
-            if not content_filled:
-                print("警告：未找到合适的正文输入框！")
-             
-            await page.wait_for_timeout(2000)
-
-            # --- 发布前截图留存 ---
-            screenshot_path = await take_screenshot(page, "before_publish")
+            image_index = await find_file_input(page, "image")
+            if image_index is not None:
+                # 本地浏览器下 set_input_files 只传文件路径，由 Chromium 直接读盘，不会经 Python 进程中转文件内容
+                await file_input.nth(image_index).set_input_files(image_paths)
+                editor_task = asyncio.ensure_future(find_editor_inputs(page))
+                print("等待图片上传...")
+                if not await wait_for_marker(page, UPLOAD_DONE, timeout=30000):
+                    print("⚠️ 等待图片上传完成标志超时，继续后续流程")
+            else:
+                raise RuntimeError("未找到上传图文的 input 元素")
+
+        # 4. 填写标题和内容
+        print("填写标题和内容...")
+        if editor_task is None:
+            editor_task = asyncio.ensure_future(find_editor_inputs(page))
+        title_selector, content_selector = await editor_task
+        
+        # 按显示宽度截断标题，保守控制在 18 个中文字符以内（小红书标题最多 20 字）
+        safe_title = truncate_title(title)
+        print(f"原标题: {title} | 截断后标题: {safe_title}")
+        
+        # 标题输入框: 使用并发查找到的第一个可用选择器
+        if title_selector:
+            await page.locator(title_selector).first.fill(safe_title)
+            print(f"使用选择器 {title_selector} 成功填写标题")
+        else:
+            print("警告：未找到合适的标题输入框！")
+
+        # 正文输入框
+        if content_selector:
+            content_box = page.locator(content_selector).first
+            if not await content_box.evaluate(INSERT_TEXT_JS, content):
+                # 整段写入没有生效（如命中的是 textarea）：点击聚焦后用键盘一次性输入
+                await content_box.click()
+                await page.keyboard.insert_text(content)
+            await page.keyboard.press("Enter")
+            print(f"使用选择器 {content_selector} 成功填写正文并追加换行")
+        else:
+            print("警告：未找到合适的正文输入框！")
+
+        # --- 发布前截图留存 ---
+        screenshot_path = await take_screenshot(page, "before_publish")
+        
+        # 5. 点击发布或暂存
+        if save_draft:
+            print("准备点击暂存离开...")
+            publish_btn = page.locator('button:has-text("暂存离开"), button:has-text("存草稿")')
+        else:
+            print("准备点击发布...")
+            publish_btn = page.locator('button.publishBtn')
+            if not await probe(publish_btn):
+                publish_btn = page.locator('button:has-text("发布")')
             
-            # 5. 点击发布或暂存
+        if await probe(publish_btn, timeout=1000):
+            await publish_btn.first.click()
+            print("等待操作完成提示...")
+            done_marker = DRAFT_DONE_TOAST if save_draft else PUBLISH_DONE_TOAST
+            if not await wait_for_marker(page, done_marker, timeout=30000):
+                print("⚠️ 未检测到操作完成提示，请查看截图确认结果")
+
+            # --- 操作后截图留存，用于确认结果 ---
+            screenshot_path = await take_screenshot(page, "after_publish" if not save_draft else "after_save_draft")
+
             if save_draft:
-                print("准备点击暂存离开...")
-                publish_btn = page.locator('button:has-text("暂存离开"), button:has-text("存草稿")')
-            else:
-                print("准备点击发布...")
-                publish_btn = page.locator('button.publishBtn')
-                if await publish_btn.count() == 0:
-                    publish_btn = page.locator('button:has-text("发布")')
-                
-            if await publish_btn.count() > 0:
-                await publish_btn.first.click()
-                print("等待操作完成提示...")
-                await page.wait_for_timeout(8000)
-
-                # --- 操作后截图留存，用于确认结果 ---
-                screenshot_path = await take_screenshot(page, "after_publish" if not save_draft else "after_save_draft")
-
-                if save_draft:
-                    print("暂存成功！页面保持打开 300 秒，供您进入草稿箱修改和发布...")
-                    try:
-                        # 循环等待，每 10 秒检查一次浏览器状态，总计 300 秒
-                        for _ in range(30):
-                            if page.is_closed():
-                                print("页面已关闭，结束等待。")
-                                break
-                            await page.wait_for_timeout(10000)
-                    except Exception as e:
-                        print(f"等待被中断或发生异常: {e}")
-
-                action_name = "发布" if not save_draft else "暂存草稿"
-                result_msg = f"Playwright 模拟点击{action_name}完成！"
-                if screenshot_path:
-                    result_msg += f"\n📸 {action_name}结果截图已保存至: {screenshot_path}"
-                return result_msg
-            else:
-                # 未找到按钮也截图，方便排查
-                screenshot_path = await take_screenshot(page, "no_publish_btn")
-                action_name = "发布" if not save_draft else "暂存离开"
-                result_msg = f"未找到{action_name}按钮，请手动点击操作。"
-                if screenshot_path:
-                    result_msg += f"\n📸 当前页面截图已保存至: {screenshot_path}"
-                return result_msg
-
-        except Exception as e:
-            # 出错时截图，方便排查
-            await take_screenshot(page, "error")
-            raise
-        finally:
-            await browser.close()
+                print("暂存成功！页面保持打开 300 秒，供您进入草稿箱修改和发布...")
+                # 用户需要在页面上继续操作，恢复正常加载图片等资源
+                await page.unroute("**/*", block_heavy_resources)
+                try:
+                    # 直接等待页面关闭事件，最长 300 秒，不再定时轮询
+                    if not page.is_closed():
+                        await page.wait_for_event("close", timeout=300000)
+                    print("页面已关闭，结束等待。")
+                except PlaywrightTimeoutError:
+                    pass
+                except Exception as e:
+                    print(f"等待被中断或发生异常: {e}")
+
+            action_name = "发布" if not save_draft else "暂存草稿"
+            result_msg = f"Playwright 模拟点击{action_name}完成！"
+            if screenshot_path:
+                result_msg += f"\n📸 {action_name}结果截图已保存至: {screenshot_path}"
+            return result_msg
+        else:
+            # 未找到按钮也截图，方便排查
+            screenshot_path = await take_screenshot(page, "no_publish_btn")
+            action_name = "发布" if not save_draft else "暂存离开"
+            result_msg = f"未找到{action_name}按钮，请手动点击操作。"
+            if screenshot_path:
+                result_msg += f"\n📸 当前页面截图已保存至: {screenshot_path}"
+            return result_msg
+
+    except Exception:
+        # 出错时截图，方便排查；必须在页面关闭前完成，take_screenshot 自身不会抛出异常
+        await take_screenshot(page, "error")
+        raise
+    finally:
+        if editor_task is not None and not editor_task.done():
+            editor_task.cancel()
 
 
 if __name__ == "__main__":
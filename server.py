@@ -1,12 +1,15 @@
 import asyncio
+import codecs
+import contextlib
+import contextvars
 import os
 import re
-import tempfile
 import uuid
 import sys
 import subprocess
 import threading
 import io
+import multiprocessing
 
 # ✅ Fix: 强制 stdout/stderr 使用 UTF-8 并开启行缓冲，防止 Windows 下 emoji 崩溃以及输出空白
 try:
@@ -21,19 +24,131 @@ try:
         sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace', line_buffering=True)
 except Exception:
     pass
-from typing import List, Dict, Any, Optional
+import functools
+import hmac
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Awaitable, Callable, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
 
 import httpx
-from bs4 import BeautifulSoup
+import orjson
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 from dotenv import load_dotenv
 from mcp.server.models import InitializationOptions
 import mcp.types as types
 from mcp.server import NotificationOptions, Server
 import mcp.server.stdio
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, OpenAIError
 from pydantic import BaseModel, Field
-from publish_playwright import publish_with_playwright
-import yt_dlp
+
+# yt-dlp 和 Playwright 导入很慢，只有探测视频 / 发布时才用得到，首次使用时再导入，加快 MCP 服务启动
+@functools.lru_cache(maxsize=1)
+def load_ytdlp():
+    import yt_dlp
+    return yt_dlp
+
+@functools.lru_cache(maxsize=1)
+def load_publisher():
+    import publish_playwright
+    return publish_playwright
+
+# tiktoken 为可选依赖，用于按 token 精确截断网页文本
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# uvloop 为可选依赖（不支持 Windows），安装后用它替换默认事件循环，加快 stdio 和网络 I/O
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# 优先使用 C 实现的 lxml 解析器，未安装时退回内置的 html.parser
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# 只构建与食谱提取相关的标签（标题、正文容器、图片、视频、脚本，以及用于过滤图片的导航/侧边栏等结构标签），
+# <head> 中的 meta/link/style 等节点直接跳过，不再生成无用的树节点
+RECIPE_STRAINER = SoupStrainer([
+    'title', 'h1', 'h2', 'h3', 'h4', 'header', 'nav', 'main', 'article', 'section', 'aside', 'footer',
+    'div', 'figure', 'ul', 'ol', 'li', 'p', 'a', 'img', 'picture', 'video', 'source', 'iframe', 'script'
+])
+
+# 送给 AI 解析的正文文本只从这些标签里取
+TEXT_BLOCK_TAGS = ['p', 'li', 'h1', 'h2', 'h3', 'h4']
+
+# 正文区域的查找条件，按优先级排列；全部是简单的标签/class/id 匹配，由 find_main_content 一次遍历完成
+CONTENT_LOCATORS = [
+    ('class', 'card-recipe-detail'),
+    ('class', 'recipe-detail'),
+    ('name', 'article'),
+    ('name', 'main'),
+    ('class', 'recipe-content'),
+    ('class', 'post-content'),
+    ('class', 'entry-content'),
+    ('id', 'recipe-block'),
+    ('class_re', re.compile('recipe-content')),
+    ('class_re', re.compile('recipe-detail')),
+    ('class_re', re.compile('recipe')),
+    ('class_re', re.compile('content')),
+]
+
+# 图片、视频链接处理用到的正则，模块加载时编译一次
+MP4_URL_RE = re.compile(r'https?://[^\s\'"]+\.mp4[^\s\'"]*')
+# 图片 URL 含这些关键词的一般是图标、头像、缩略图或统计像素，直接忽略
+IMAGE_SKIP_RE = re.compile(r'icon|logo|avatar|gif|svg|thumb|small|150x150|300x300|impression|pixel|dummy', re.IGNORECASE)
+RESIZED_SUFFIX_RE = re.compile(r'-\d+x\d+\.(jpg|jpeg|png)$', re.IGNORECASE)
+EXT_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9]')
+
+# 用来过滤非正文图片：祖先节点是这些标签，或 class 含这些关键词（侧边栏、推荐、分类卡片等）的图片都跳过
+CONTENT_IMAGE_CLASS_RE = re.compile(r'wp-image|recipe-image|post-image|content-image')
+EXCLUDED_ANCESTOR_TAGS = frozenset(['aside', 'footer', 'nav'])
+EXCLUDED_CLASS_RE = re.compile(
+    '|'.join(map(re.escape, ['sidebar', 'widget', 'related', 'recommended', 'footer', 'nav', 'author', 'promo', 'category', 'categories', 'recipe-card', 'index-categories'])),
+    re.IGNORECASE,
+)
+
+# 下载图片时根据响应的 Content-Type 决定后缀，比解析 URL 更可靠（很多 CDN 链接没有后缀或带查询参数）
+IMAGE_CONTENT_TYPES = {
+    'image/jpeg': 'jpg',
+    'image/jpg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+}
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# 常驻发布进程监听的本机端口，以及空闲多久后自动退出
+PUBLISH_WORKER_PORT = int(os.getenv("PUBLISH_WORKER_PORT", "47821"))
+PUBLISH_WORKER_IDLE_SECONDS = 600
+# 发布进程通信密钥，只有当前用户可读写；任务和确认都用它签名，本机其他进程无法冒充或投递任务
+PUBLISH_WORKER_KEY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_media", "publish-worker.key")
+
+# 抓取网页时最多读取的字节数；小于 MIN_PAGE_BYTES 且不含任何标签的响应视为空页面
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+MIN_PAGE_BYTES = 500
+
+# 页面开头 <meta charset="..."> 或 <meta http-equiv="Content-Type" content="...; charset=..."> 中声明的编码
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+META_CHARSET_SCAN_BYTES = 4096
+
+# 小红书单篇笔记最多 9 张图
+MAX_NOTE_IMAGES = 9
+
+# yt-dlp 等同步阻塞调用专用的线程池，避免多个工具调用并发时占满默认 executor
+BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="blocking-io")
+
+# 解析网页 HTML 的进程池：BeautifulSoup 解析是占着 GIL 的 CPU 密集操作，放到子进程里不会卡住其他工具调用
+PARSE_POOL_WORKERS = min(4, os.cpu_count() or 1)
+# 单个页面在进程池里解析的最长等待时间（含首次启动子进程、导入模块的耗时），超时后改在线程中解析
+PARSE_TIMEOUT_SECONDS = 30
 
 # 加载环境变量
 load_dotenv()
@@ -46,6 +161,69 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 MODEL_NAME = os.getenv("MODEL_NAME", "gpt-3.5-turbo")
 
+@functools.lru_cache(maxsize=None)
+def get_ai_client() -> AsyncOpenAI:
+    """全进程共用一个 OpenAI 客户端，抽取和生成文案两次调用复用同一个连接池
+
+    底层 httpx 客户端开启 HTTP/2，并发的多个 AI 请求可以在同一条连接上多路复用。
+    """
+    http_client = httpx.AsyncClient(http2=True, limits=httpx.Limits(max_keepalive_connections=20))
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=2, timeout=60, http_client=http_client)
+
+# 网页正文送入 AI 前按 token 截断，中英文混排时比按字符截断更准确
+PROMPT_TEXT_TOKENS = 2500
+PROMPT_TEXT_CHARS = 4000  # 未安装 tiktoken 或编码表没能及时加载时退回按字符截断
+# 首次使用时 tiktoken 会同步下载编码表且没有超时，截断时最多等这么久，没加载好就先按字符截断
+TOKEN_ENCODER_LOAD_TIMEOUT = 5
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoder(model_name: str):
+    """按模型名获取 tiktoken 编码器；未安装 tiktoken 或无法加载编码表时返回 None"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # 非 OpenAI 模型（兼容接口）没有对应的编码表，用通用编码近似
+        try:
+            return tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            return None
+    except Exception:
+        return None
+
+_token_encoder_ready = threading.Event()
+_token_encoder_loading = threading.Lock()
+_token_encoder_waited = False  # 已经等过一次没等到，之后不再等，加载完成前一律按字符截断
+
+def start_token_encoder_load():
+    """在后台守护线程里加载编码器（只启动一次），不阻塞调用方；卡住的下载也不会拖住进程退出"""
+    if not _token_encoder_loading.acquire(blocking=False):
+        return
+    def load():
+        get_token_encoder(MODEL_NAME)
+        _token_encoder_ready.set()
+    threading.Thread(target=load, name="tiktoken-load", daemon=True).start()
+
+def trim_to_token_budget(text: str, max_tokens: int = PROMPT_TEXT_TOKENS) -> str:
+    """把文本截断到 max_tokens 个 token 以内，避免超出 token 限制
+
+    编码较长文本比较耗 CPU，只在事件循环之外调用（网页解析时完成截断）。
+    """
+    global _token_encoder_waited
+    start_token_encoder_load()
+    if _token_encoder_ready.wait(0 if _token_encoder_waited else TOKEN_ENCODER_LOAD_TIMEOUT):
+        enc = get_token_encoder(MODEL_NAME)
+    else:
+        _token_encoder_waited = True
+        enc = None
+    if enc is None:
+        return text[:PROMPT_TEXT_CHARS]
+    tokens = enc.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
 class RecipeData(BaseModel):
     title: str = Field(description="食谱标题")
     ingredients: List[str] = Field(description="食材列表")
@@ -53,8 +231,383 @@ class RecipeData(BaseModel):
     image_urls: List[str] = Field(description="图片链接列表")
     video_url: Optional[str] = Field(default=None, description="视频链接")
 
-async def extract_recipe_from_url(url: str) -> RecipeData:
-    """从任意网页或本地HTML提取食谱内容和图片"""
+    @functools.cached_property
+    def image_urls_preview(self) -> str:
+        """草稿回复里展示的前 9 张图片链接，每行一个；缓存命中的同一食谱对象只拼接一次"""
+        return "\n".join(self.image_urls[:MAX_NOTE_IMAGES])
+
+class ScrapedPage(BaseModel):
+    """网页抓取解析后、交给 AI 之前的中间结果"""
+    title: str = ""
+    text: str = ""
+    image_urls: List[str] = []
+    video_url: Optional[str] = None
+    # 不是网页（PDF、视频直链、空页面、读取失败等）时为 False，后续不再调用 AI 和 yt-dlp
+    is_html: bool = True
+
+def async_ttl_cache(maxsize: int = 128, ttl: float = 600, key=None):
+    """给异步函数加一个带过期时间的 LRU 缓存
+
+    缓存只在当前进程内有效：MCP 进程里反复草稿同一个网址时，可以直接复用上一次的抓取和 AI 结果
+    （后台发布在单独的发布进程里，不共享这里的缓存）。
+    同一个键还在执行中时，后到的调用直接等待同一个任务，不会重复抓取和调用 AI。
+    抛出异常的调用不会写入缓存，下次会重新执行。
+    """
+    def decorator(func):
+        cache: "OrderedDict[Any, tuple]" = OrderedDict()
+        pending: Dict[Any, asyncio.Future] = {}
+
+        def store(cache_key, future: asyncio.Future):
+            pending.pop(cache_key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            cache[cache_key] = (time.monotonic(), future.result())
+            cache.move_to_end(cache_key)
+            while len(cache) > maxsize:
+                cache.popitem(last=False)
+
+        @functools.wraps(func)
+        async def wrapper(*args):
+            cache_key = key(*args) if key else args
+            hit = cache.get(cache_key)
+            if hit and time.monotonic() - hit[0] < ttl:
+                cache.move_to_end(cache_key)
+                return hit[1]
+            future = pending.get(cache_key)
+            if future is None:
+                future = asyncio.ensure_future(func(*args))
+                pending[cache_key] = future
+                future.add_done_callback(functools.partial(store, cache_key))
+            # shield：某个调用方被取消时，不影响其他正在等待同一结果的调用
+            return await asyncio.shield(future)
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+# 分享链接里常见的追踪参数，不影响页面内容，作为缓存键时去掉
+TRACKING_PARAM_RE = re.compile(r'^(?:utm_\w+|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|igshid|spm|_ga)$', re.I)
+
+def normalize_url(url: str) -> str:
+    """把网址规整成缓存键：协议和域名转小写，去掉追踪参数和 # 锚点；本地路径原样返回"""
+    parsed = urlparse(url)
+    if parsed.scheme.lower() not in ('http', 'https'):
+        return url
+    query = urlencode([(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True) if not TRACKING_PARAM_RE.match(k)])
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path or '/', parsed.params, query, ''))
+
+class YdlNullLogger:
+    """丢弃 yt-dlp 所有日志的 logger
+
+    关闭浏览器 cookie 窃取，因为它在 Windows 上容易引起讨厌但无害的红字报错，
+    用它让 yt-dlp 不要把错误打到 stderr 搞脏屏幕。
+    """
+    def debug(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        pass
+
+# 探测视频地址时的 yt-dlp 参数，模块加载时构建一次
+YDL_PROBE_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': True,
+    'no_color': True,
+    'logger': YdlNullLogger(),
+}
+
+# 探测用的 YoutubeDL 实例初始化要加载全部提取器，开销不小；YoutubeDL 不是线程安全的，
+# 所以线程池里每个线程各缓存一个实例重复使用
+_probe_ydl_local = threading.local()
+
+def get_probe_ydl():
+    """获取当前线程缓存的探测用 YoutubeDL 实例"""
+    ydl = getattr(_probe_ydl_local, 'ydl', None)
+    if ydl is None:
+        ydl = _probe_ydl_local.ydl = load_ytdlp().YoutubeDL(params=dict(YDL_PROBE_OPTS))
+    return ydl
+
+def extract_video_url_with_ytdlp(url: str) -> Optional[str]:
+    """通过 yt-dlp 提取视频 URL（同步阻塞，需在线程池中调用）
+
+    YouTube / Vimeo 等专业视频站需要特殊处理
+    """
+    video_url = None
+    try:
+         info = get_probe_ydl().extract_info(url, download=False)
+         if info:
+             video_url = info.get('url')
+             # 如果是嵌套在某些页面中的视频，可能需要取第一个格式
+             formats = info.get('formats')
+             if video_url is None and formats:
+                 for f in reversed(formats):
+                     if f.get('url') and f.get('vcodec') != 'none':
+                         video_url = f.get('url')
+                         break
+    except Exception as e:
+         print(f"yt-dlp 提取视频 URL 失败: {e}")
+    return video_url
+
+EXTRACTION_SYSTEM_PROMPT = "你是一个专业的食谱信息提取助手，只返回符合格式的 JSON。"
+
+class BatchAIExtractor:
+    """把短时间窗口内的多个食谱提取请求合并成一次 AI 调用
+
+    同一会话里连续草稿多个网址时，每个网址单独请求很容易先撞上每分钟请求数（RPM）限制。
+    第一个请求到达后等待 window 秒，把期间排队的请求（最多 max_batch 个）拼成一个多任务 prompt；
+    窗口内只有一个请求时仍走原来的单次调用。合并结果解析失败时退回逐个单独调用。
+    """
+
+    def __init__(self, window: float = 0.05, max_batch: int = 4):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[tuple] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._running: set = set()  # 持有批次任务的引用，防止被垃圾回收
+
+    async def extract(self, text: str) -> Dict[str, Any]:
+        """提取一段网页文本（已由 parse_recipe_html 按 token 预算截断）中的食材和步骤，返回 {"ingredients": [...], "steps": [...]}"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            # 批次已满，不再等窗口结束
+            batch, self._pending = self._pending, []
+            self._spawn(self._run_batch(batch))
+        elif self._flush_task is None:
+            self._flush_task = self._spawn(self._flush_after_window())
+        return await future
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.ensure_future(coro)
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        return task
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        batch, self._pending = self._pending, []
+        if batch:
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch: List[tuple]):
+        texts = [text for text, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            if len(texts) == 1:
+                results = [await self._extract_one(texts[0])]
+            else:
+                results = await self._extract_many(texts)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _complete(self, prompt: str) -> Dict[str, Any]:
+        ai_client = get_ai_client()
+        completion = await ai_client.chat.completions.create(
+            model=MODEL_NAME,
+            messages=[
+                {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"}
+        )
+        content = completion.choices[0].message.content
+        return orjson.loads(content) if content else {}
+
+    async def _extract_one(self, text: str) -> Dict[str, Any]:
+        prompt = f"""
+请从以下网页文本中提取食谱信息，并翻译为中文。
+如果文本中不包含食谱，请尽力提取主要内容作为步骤。
+
+网页文本：
+{text}
+
+请返回 JSON 格式，包含以下字段：
+- ingredients: 字符串数组，包含所需食材的中文翻译
+- steps: 字符串数组，包含制作步骤的中文翻译
+"""
+        data = await self._complete(prompt)
+        return {"ingredients": data.get("ingredients", []), "steps": data.get("steps", [])}
+
+    async def _extract_many(self, texts: List[str]) -> List[Dict[str, Any]]:
+        tasks = "\n\n".join(f"【任务 {i}】\n{text}" for i, text in enumerate(texts, 1))
+        prompt = f"""
+下面有 {len(texts)} 段互不相关的网页文本，请分别从每一段中提取食谱信息，并翻译为中文。
+如果某段文本中不包含食谱，请尽力提取主要内容作为步骤。
+
+{tasks}
+
+请返回 JSON 格式，只包含一个字段：
+- results: 数组，长度必须为 {len(texts)}，按任务顺序排列，每一项包含：
+  - ingredients: 字符串数组，包含所需食材的中文翻译
+  - steps: 字符串数组，包含制作步骤的中文翻译
+"""
+        try:
+            data = await self._complete(prompt)
+            results = data.get("results")
+            if isinstance(results, list) and len(results) == len(texts) and all(isinstance(r, dict) for r in results):
+                return [{"ingredients": r.get("ingredients", []), "steps": r.get("steps", [])} for r in results]
+            print("合并提取返回的结果数量不符，改为逐个提取", file=sys.stderr)
+        except Exception as e:
+            print(f"合并提取失败 ({e})，改为逐个提取", file=sys.stderr)
+        return list(await asyncio.gather(*(self._extract_one(text) for text in texts)))
+
+ai_extractor = BatchAIExtractor()
+
+def _matches_locator(tag: Tag, classes, locator) -> bool:
+    kind, value = locator
+    if kind == 'class':
+        return value in classes
+    if kind == 'name':
+        return tag.name == value
+    if kind == 'id':
+        return tag.get('id') == value
+    return any(value.search(c) for c in classes)
+
+def find_main_content(soup: BeautifulSoup) -> Optional[Tag]:
+    """按 CONTENT_LOCATORS 的优先级找正文区域，只遍历一次文档
+
+    结果与依次对每个条件调用 soup.find 相同：返回优先级最高的条件在文档中的第一个匹配。
+    遍历时只需检查比当前最佳结果优先级更高的条件，命中最高优先级后立即停止。
+    """
+    best: Optional[Tag] = None
+    best_rank = len(CONTENT_LOCATORS)
+    for tag in soup.descendants:
+        if not isinstance(tag, Tag):
+            continue
+        classes = tag.get('class') or ()
+        for rank in range(best_rank):
+            if _matches_locator(tag, classes, CONTENT_LOCATORS[rank]):
+                best, best_rank = tag, rank
+                break
+        if best_rank == 0:
+            break
+    return best
+
+def _inside_text_block(tag: Tag, root: Tag) -> bool:
+    """tag 在 root 之内是否还被另一个 TEXT_BLOCK_TAGS 块包着"""
+    for parent in tag.parents:
+        if parent is root:
+            return False
+        if parent.name in TEXT_BLOCK_TAGS:
+            return True
+    return False
+
+def detect_page_encoding(body: bytes, header_encoding: Optional[str] = None) -> str:
+    """确定网页编码：响应头的 charset 优先，其次是页面开头 <meta> 声明的 charset，都没有就按 UTF-8
+
+    只看开头一小段字节，不做整篇的编码猜测扫描；GBK 等国内站点常只在 <meta> 里声明编码，
+    按 UTF-8 硬解会变成乱码。
+    """
+    for candidate in (header_encoding, _meta_charset(body)):
+        if candidate:
+            try:
+                return codecs.lookup(candidate).name
+            except LookupError:
+                continue
+    return 'utf-8'
+
+def _meta_charset(body: bytes) -> Optional[str]:
+    match = META_CHARSET_RE.search(body, 0, META_CHARSET_SCAN_BYTES)
+    return match.group(1).decode('ascii') if match else None
+
+# 抓取网页时模拟浏览器的请求头
+PAGE_REQUEST_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+    "Sec-Ch-Ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
+    "Sec-Ch-Ua-Mobile": "?0",
+    "Sec-Ch-Ua-Platform": '"Windows"',
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1",
+    "Upgrade-Insecure-Requests": "1"
+}
+
+# 抓取网页共用的 HTTP/2 客户端，首次使用时创建，进程退出前由 close_page_client 关闭
+_PAGE_CLIENT: Optional[httpx.AsyncClient] = None
+
+def get_page_client() -> httpx.AsyncClient:
+    """获取（必要时创建）共享的网页抓取客户端，连续抓取同一站点时复用已建立的 TCP/TLS 连接"""
+    global _PAGE_CLIENT
+    if _PAGE_CLIENT is None or _PAGE_CLIENT.is_closed:
+        _PAGE_CLIENT = httpx.AsyncClient(
+            follow_redirects=True,
+            http2=True,
+            headers=PAGE_REQUEST_HEADERS,
+            timeout=30,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return _PAGE_CLIENT
+
+async def close_page_client():
+    """关闭共享的网页抓取客户端"""
+    global _PAGE_CLIENT
+    if _PAGE_CLIENT is not None:
+        await _PAGE_CLIENT.aclose()
+        _PAGE_CLIENT = None
+
+@functools.lru_cache(maxsize=None)
+def get_parse_pool() -> ProcessPoolExecutor:
+    """首次解析网页时才创建进程池，进程退出前由 shutdown_parse_pool 关闭
+
+    固定用 spawn 启动子进程：MCP 的 stdio 读线程一直阻塞在 stdin 上，fork 出的子进程
+    在启动时关闭 stdin 会卡死在那个线程持有的锁上。
+    """
+    # 子进程不共享父进程已加载的 tiktoken 编码器，启动时各自在后台开始加载，首次解析时通常已就绪
+    return ProcessPoolExecutor(
+        max_workers=PARSE_POOL_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=start_token_encoder_load,
+    )
+
+# 进程池出过故障（无法启动或解析超时）后不再使用，之后的页面都在线程中解析
+parse_pool_disabled = False
+
+def shutdown_parse_pool():
+    """关闭解析进程池（未创建过时什么也不做）"""
+    if get_parse_pool.cache_info().currsize:
+        get_parse_pool().shutdown(wait=False, cancel_futures=True)
+        get_parse_pool.cache_clear()
+
+async def scrape_recipe_page(url: str, client: Optional[httpx.AsyncClient] = None) -> ScrapedPage:
+    """抓取任意网页或本地HTML，解析出标题、正文文本、图片和页面里直接能找到的视频链接
+
+    默认复用模块级的网页抓取客户端，也可以显式传入 client。
+    抓取在事件循环里进行，解析交给进程池；进程池不可用时退回线程池。
+    """
+    html_content = await fetch_page_html(url, client)
+    if isinstance(html_content, ScrapedPage):
+        return html_content
+    global parse_pool_disabled
+    loop = asyncio.get_running_loop()
+    if not parse_pool_disabled:
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(get_parse_pool(), parse_recipe_html, html_content, url),
+                PARSE_TIMEOUT_SECONDS,
+            )
+        except (BrokenProcessPool, OSError, asyncio.TimeoutError) as e:
+            print(f"解析进程池不可用 ({e!r})，之后改在线程中解析", file=sys.stderr)
+            parse_pool_disabled = True
+            shutdown_parse_pool()
+    return await loop.run_in_executor(BLOCKING_EXECUTOR, parse_recipe_html, html_content, url)
+
+async def fetch_page_html(url: str, client: Optional[httpx.AsyncClient] = None) -> Union[str, ScrapedPage]:
+    """读取本地 HTML 或抓取网页，返回解码后的 HTML 文本；明显不是网页时直接返回不需再解析的 ScrapedPage"""
     html_content = ""
         # 判断是否为本地文件
     if os.path.isfile(url) or url.startswith('file://'):
@@ -72,80 +625,89 @@ async def extract_recipe_from_url(url: str) -> RecipeData:
                 html_content = f.read()
         except Exception as e:
             print(f"读取本地文件失败 ({e})")
-            return RecipeData(title="", ingredients=[], steps=[], image_urls=[], video_url=None)
+            return ScrapedPage(is_html=False)
     else:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-            "Sec-Ch-Ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
-            "Sec-Ch-Ua-Mobile": "?0",
-            "Sec-Ch-Ua-Platform": '"Windows"',
-            "Sec-Fetch-Dest": "document",
-            "Sec-Fetch-Mode": "navigate",
-            "Sec-Fetch-Site": "none",
-            "Sec-Fetch-User": "?1",
-            "Upgrade-Insecure-Requests": "1"
-        }
-        
         # 尝试使用 httpx 抓取
         try:
-            async with httpx.AsyncClient(follow_redirects=True, http2=True) as client:
-                response = await client.get(url, headers=headers)
+            client = client or get_page_client()
+            async with client.stream('GET', url) as response:
                 response.raise_for_status()
-                html_content = response.text
+                # 明显不是网页（PDF、图片、视频直链等）时不必解析，也不浪费 AI 调用；视频直链直接作为视频返回
+                content_type = response.headers.get('content-type', '').lower()
+                if content_type and 'html' not in content_type and not content_type.startswith('text/'):
+                    print(f"页面不是网页文本 ({content_type})，跳过解析", file=sys.stderr)
+                    return ScrapedPage(
+                        video_url=url if content_type.startswith('video/') else None,
+                        is_html=False,
+                    )
+                # 分块读取，超过上限就不再往下读：食谱正文都在页面前部，后面多是评论区和推荐列表
+                body = bytearray()
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    body += chunk
+                    if len(body) >= MAX_PAGE_BYTES:
+                        break
+                if len(body) < MIN_PAGE_BYTES and b'<' not in body:
+                    print("页面内容为空或不是 HTML，跳过解析", file=sys.stderr)
+                    return ScrapedPage(is_html=False)
+                html_content = bytes(body[:MAX_PAGE_BYTES]).decode(
+                    detect_page_encoding(body, response.charset_encoding), errors='replace'
+                )
         except Exception as e:
             print(f"HTTP 请求失败 ({e})，尝试使用 Playwright 抓取...")
             # 如果 httpx 失败 (比如遇到 Cloudflare 或 403)，回退到 playwright
             from playwright.async_api import async_playwright
             async with async_playwright() as p:
                 browser = await p.chromium.launch(headless=True)
-                context = await browser.new_context(user_agent=headers["User-Agent"])
+                context = await browser.new_context(user_agent=PAGE_REQUEST_HEADERS["User-Agent"])
                 page = await context.new_page()
                 await page.goto(url, wait_until="domcontentloaded", timeout=30000)
                 html_content = await page.content()
                 await browser.close()
-            
-    soup = BeautifulSoup(html_content, 'html.parser')
+    return html_content
+
+def parse_recipe_html(html_content: str, url: str) -> ScrapedPage:
+    """解析网页 HTML，取出标题、正文文本、图片和视频链接
+
+    纯同步函数，参数和返回值都可以 pickle，在解析进程池里执行。url 用于补全相对路径。
+    """
+    soup = BeautifulSoup(html_content, HTML_PARSER, parse_only=RECIPE_STRAINER)
 
     # 提取标题 (尝试几种常见的标题标签)
+    # <title> 位于文档开头，find 找到第一个就返回；get_text 在 <title> 为空或含多个子节点时也不会因 .string 为 None 而报错
     title = ""
-    if soup.title:
-        title = soup.title.string.strip()
+    title_tag = soup.find('title')
+    if title_tag:
+        title = title_tag.get_text(strip=True)
     if not title:
         h1 = soup.find('h1')
         if h1:
-            title = h1.text.strip()
+            title = h1.get_text(strip=True)
             
     # 尝试寻找主要的食谱内容区域，以避免抓取到侧边栏或推荐菜谱的图片
-    main_content = soup
-    content_selectors = [
-        '.card-recipe-detail',
-        '.recipe-detail',
-        'article',
-        'main',
-        '.recipe-content',
-        '.post-content',
-        '.entry-content',
-        '#recipe-block',
-        '[class*="recipe-content"]',
-        '[class*="recipe-detail"]',
-        '[class*="recipe"]',
-        '[class*="content"]'
-    ]
-    
-    for selector in content_selectors:
-        found = soup.select_one(selector)
-        if found:
-            main_content = found
-            break
+    main_content = find_main_content(soup) or soup
 
     # 提取所有文本以供 AI 解析
-    # 移除脚本和样式
+    # 移除脚本和样式；这些节点之后不再使用，用 decompose 直接销毁，不像 extract 那样保留成独立的子树
     for script in main_content(["script", "style", "nav", "footer", "header", "aside"]):
-        script.extract()
-    text = main_content.get_text(separator='\n', strip=True)
-    
+        if not script.decomposed:
+            script.decompose()
+    # 食谱信息基本都在段落、列表项和小标题里，只取这些标签的文本，跳过残留的菜单、评论等零散文字；
+    # 嵌套的块（如 <li><p>…</p></li>）只取最外层，内层文字已包含在外层里；
+    # 页面结构特殊、一个都取不到时退回整个区域的全部文本
+    text = '\n'.join(
+        block_text
+        for block_text in (
+            el.get_text(' ', strip=True)
+            for el in main_content.find_all(TEXT_BLOCK_TAGS)
+            if not _inside_text_block(el, main_content)
+        )
+        if block_text
+    )
+    if not text:
+        text = main_content.get_text(separator='\n', strip=True)
+    # 按 token 预算截断后再交给 AI；在解析进程（或线程）里完成，不占用事件循环
+    text = trim_to_token_budget(text)
+
     # 尝试通过 BeautifulSoup 寻找视频链接，如果 yt-dlp 失败
     video_url = None
     for video in main_content.find_all('video'):
@@ -181,30 +743,40 @@ async def extract_recipe_from_url(url: str) -> RecipeData:
         if not video_url:
             for script in main_content.find_all('script'):
                 if script.string and '.mp4' in script.string:
-                    import re
-                    match = re.search(r'https?://[^\s\'"]+\.mp4[^\s\'"]*', script.string)
+                    match = MP4_URL_RE.search(script.string)
                     if match:
                         video_url = match.group(0)
                         break
     
-    # 提取图片 URL
+    # 提取图片 URL（集合用于 O(1) 去重，列表保留页面顺序，特色大图不会被打乱到后面丢掉）
     images = []
+    images_seen = set()
     
-    # 一些用来过滤非正文图片的特征关键词
-    exclude_classes = ['sidebar', 'widget', 'related', 'recommended', 'footer', 'nav', 'author', 'promo', 'category', 'categories', 'recipe-card', 'index-categories']
-    
-    # 获取原始的所有 img 标签，因为 main_content 可能切得太狠了
-    for img in main_content.find_all('img') + soup.find_all('img', class_='featured-image'):
+    # 页面 URL 只解析一次；网络页面上的相对路径（/a.jpg、img/a.jpg、../a.jpg）统一用 urljoin 补全
+    is_remote_page = urlparse(url).scheme in ('http', 'https')
+
+    # 只遍历一次整棵树的 img 标签：特色大图不论在哪都保留（main_content 可能切得太狠了），
+    # 其余图片必须位于 main_content 之内
+    for img in soup.find_all('img'):
         # 检查图片是否在不该在的地方
         skip = False
+        img_classes = img.get('class') or []
         # 如果是特色大图，不要跳过
-        if 'featured-image' not in img.get('class', []):
+        if 'featured-image' in img_classes:
+            pass
+        # 明显的正文配图（如 WordPress 的 wp-image-123）不用逐层检查祖先的 class，只需确认在正文区域内
+        elif img_classes and CONTENT_IMAGE_CLASS_RE.search(" ".join(img_classes)):
+            skip = not (main_content is soup or any(parent is main_content for parent in img.parents))
+        else:
+            in_main = main_content is soup or main_content is img
             for parent in img.parents:
-                if parent.name in ['aside', 'footer', 'nav']:
+                if parent is main_content:
+                    in_main = True
+                if parent.name in EXCLUDED_ANCESTOR_TAGS:
                     skip = True
                     break
-                class_str = " ".join(parent.get('class', []))
-                if any(exc in class_str.lower() for exc in exclude_classes):
+                classes = parent.get('class')
+                if classes and EXCLUDED_CLASS_RE.search(" ".join(classes)):
                     skip = True
                     break
                 
@@ -215,6 +787,8 @@ async def extract_recipe_from_url(url: str) -> RecipeData:
                     if href and url not in href and not href.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif')) and not href.startswith('#'):
                         skip = True
                         break
+            else:
+                skip = not in_main
         
         if skip:
             continue
@@ -224,131 +798,236 @@ async def extract_recipe_from_url(url: str) -> RecipeData:
             # 处理相对路径
             if src.startswith('//'):
                 src = 'https:' + src
+            elif is_remote_page and not src.startswith(('http://', 'https://')):
+                src = urljoin(url, src)
             elif src.startswith('/'):
-                from urllib.parse import urlparse
-                parsed_url = urlparse(url)
-                src = f"{parsed_url.scheme}://{parsed_url.netloc}{src}"
+                # 本地 HTML 里以 / 开头的是原网站的站内路径，没有域名无法补全，跳过
+                continue
             
             # 简单过滤：忽略太小的图标或者 base64
-            if src.startswith('http') and not any(skip_word in src.lower() for skip_word in ['icon', 'logo', 'avatar', 'gif', 'svg', 'thumb', 'small', '150x150', '300x300', 'impression', 'pixel', 'dummy']):
+            if src.startswith('http') and not IMAGE_SKIP_RE.search(src):
                 # 如果 URL 中有查询参数控制大小（比如 wp 的图像），尽量保留原图
-                import re
-                src = re.sub(r'-\d+x\d+\.(jpg|jpeg|png)$', r'.\1', src, flags=re.IGNORECASE)
-                if src not in images:
+                src = RESIZED_SUFFIX_RE.sub(r'.\1', src)
+                if src not in images_seen:
+                    images_seen.add(src)
                     images.append(src)
             elif src.startswith('file://') or os.path.isabs(src): # 支持本地图片
-                if src not in images:
+                if src not in images_seen:
+                    images_seen.add(src)
                     images.append(src)
+
+            # 小红书最多 9 张图，凑够了就不用再看剩下的图片
+            if len(images) >= MAX_NOTE_IMAGES:
+                break
     
-    # 使用 AI 解析网页文本，提取结构化的食谱数据
-    ai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-    prompt = f"""
-请从以下网页文本中提取食谱信息，并翻译为中文。
-如果文本中不包含食谱，请尽力提取主要内容作为步骤。
+    return ScrapedPage(title=title, text=text, image_urls=images, video_url=video_url)
 
-网页文本：
-{text[:4000]} # 截断以避免超出 token 限制
+async def _await_with_video_probe(ai_task, page: ScrapedPage, url: str):
+    """等待 AI 调用结果；页面里没找到视频时同时用 yt-dlp 探测，返回 (AI 结果, 视频链接)
 
-请返回 JSON 格式，包含以下字段：
-- ingredients: 字符串数组，包含所需食材的中文翻译
-- steps: 字符串数组，包含制作步骤的中文翻译
-"""
-    completion = await ai_client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=[
-            {"role": "system", "content": "你是一个专业的食谱信息提取助手，只返回符合格式的 JSON。"},
-            {"role": "user", "content": prompt}
-        ],
-        response_format={"type": "json_object"}
+    AI 解析和 yt-dlp 探测视频互不依赖，同时进行；yt-dlp 是同步阻塞调用，放到线程池里执行。
+    """
+    if page.video_url or not page.is_html:
+        return await ai_task, page.video_url
+    loop = asyncio.get_running_loop()
+    result, video_url = await asyncio.gather(
+        ai_task,
+        loop.run_in_executor(BLOCKING_EXECUTOR, extract_video_url_with_ytdlp, url),
     )
-    
-    import json
-    content = completion.choices[0].message.content
-    if content:
-       extracted_data = json.loads(content)
+    return result, video_url
+
+@async_ttl_cache(maxsize=128, ttl=600, key=normalize_url)
+async def extract_recipe_from_url(url: str) -> RecipeData:
+    """从任意网页或本地HTML提取食谱内容和图片"""
+    page = await scrape_recipe_page(url)
+
+    # 使用 AI 解析网页文本，提取结构化的食谱数据（短时间内的多个请求会被合并成一次调用）
+    # 页面上一点正文都没有时（错误页、纯脚本渲染的空壳页）不必调用 AI
+    if page.text:
+        ai_task = ai_extractor.extract(page.text)
     else:
-       extracted_data = {"ingredients": [], "steps": []}
-    
-    # 尝试通过 yt-dlp 提取视频 URL
-    # YouTube / Vimeo 等专业视频站需要特殊处理
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-        'nocheckcertificate': True,
-        'ignoreerrors': True,
-        'no_color': True,
-        # 关闭浏览器 cookie 窃取，因为它在 Windows 上容易引起讨厌但无害的红字报错
-        # 我们用一个 dummy 选项让它不要把错误打到 stderr 搞脏屏幕
-        # ✅ Fix: lambda 需要接受 (self, msg) 两个参数，否则 yt-dlp 调用时报 TypeError
-        'logger': type('DummyLogger', (object,), {'debug': lambda self, msg: None, 'warning': lambda self, msg: None, 'error': lambda self, msg: None})(),
-    }
-    if not video_url:
-        try:
-             with yt_dlp.YoutubeDL(params=ydl_opts) as ydl: # type: ignore
-                 info = ydl.extract_info(url, download=False)
-                 if info:
-                     video_url = info.get('url')
-                     # 如果是嵌套在某些页面中的视频，可能需要取第一个格式
-                     formats = info.get('formats')
-                     if video_url is None and formats:
-                         for f in reversed(formats):
-                             if f.get('url') and f.get('vcodec') != 'none':
-                                 video_url = f.get('url')
-                                 break
-        except Exception as e:
-             print(f"yt-dlp 提取视频 URL 失败: {e}")
+        ai_task = asyncio.sleep(0, result={"ingredients": [], "steps": []})
+    extracted_data, video_url = await _await_with_video_probe(ai_task, page, url)
 
     return RecipeData(
-        title=title,
+        title=page.title,
         ingredients=extracted_data.get('ingredients', []),
         steps=extracted_data.get('steps', []),
-        image_urls=list(set(images))[:9], # 小红书最多 9 张图
+        image_urls=page.image_urls,
         video_url=video_url
     )
 
+# 小红书笔记的文案要求，单独生成笔记和“提取+生成”合并调用共用同一份
+XHS_POST_REQUIREMENTS = """1. 标题（绝对不能超过18个字符，包含emoji在内）：必须极具吸睛效果，切中痛点或带有夸张吸引力（例如：绝了！被全家夸上天的神仙XXX）。
+2. 开篇引入：用 1-2 句话讲述一个引起共鸣的小故事或日常场景（例如：周末不知道吃什么？/ 闺蜜尝了一口直接找我要配方），迅速抓住读者眼球。
+3. 食材清单：清晰列出所有必需食材，可适当标注份量或替代品提示。
+4. 制作步骤：分点撰写，语言必须通俗易懂、具有极强的实操性。每一步的核心动作要加粗或用 emoji 点缀，让新手也能一看就会。
+5. 爆款话题（Hashtag）：结尾处必须提供 5-8 个自带高流量的精准话题（例如：#小红书爆款美食 #神仙吃法 #懒人食谱 等）。
+6. 排版与字数：全文总字数严格控制在 800 字以内。大量使用 emoji 提升阅读体验，段落之间留出空行，保持排版呼吸感。
+7. 格式警告：小红书正文不支持 Markdown 格式！请绝对不要使用 `**加粗**`、`# 标题` 或 `- 列表` 等 Markdown 语法，请仅使用纯文本、换行和 Emoji 进行排版。"""
+
+XHS_POST_SYSTEM_PROMPT = "你是一个熟练掌握小红书爆款文案风格的美食博主，只返回 JSON。"
+
+# 流式生成文案时的进度回调，参数是已收到的字符数；由 handle_call_tool 按请求设置，未设置时不汇报
+POST_PROGRESS_CALLBACK: "contextvars.ContextVar[Optional[Callable[[int], Awaitable[None]]]]" = contextvars.ContextVar(
+    "POST_PROGRESS_CALLBACK", default=None
+)
+# 每收到这么多字符汇报一次进度，避免给客户端发太多通知
+POST_PROGRESS_STEP_CHARS = 200
+
+@async_ttl_cache(maxsize=128, ttl=600, key=lambda recipe: recipe.model_dump_json())
 async def generate_xiaohongshu_post(recipe: RecipeData) -> Dict[str, str]:
     """根据食谱数据生成小红书风格的笔记"""
-    ai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-    
+    ai_client = get_ai_client()
+    steps_text = "\n".join(recipe.steps)
+
     prompt = f"""
 请根据以下提取的食谱信息，为我生成一篇【有故事性、实用性】的爆款小红书美食笔记。
 
 【核心要求】
-1. 标题（绝对不能超过18个字符，包含emoji在内）：必须极具吸睛效果，切中痛点或带有夸张吸引力（例如：绝了！被全家夸上天的神仙XXX）。
-2. 开篇引入：用 1-2 句话讲述一个引起共鸣的小故事或日常场景（例如：周末不知道吃什么？/ 闺蜜尝了一口直接找我要配方），迅速抓住读者眼球。
-3. 食材清单：清晰列出所有必需食材，可适当标注份量或替代品提示。
-4. 制作步骤：分点撰写，语言必须通俗易懂、具有极强的实操性。每一步的核心动作要加粗或用 emoji 点缀，让新手也能一看就会。
-5. 爆款话题（Hashtag）：结尾处必须提供 5-8 个自带高流量的精准话题（例如：#小红书爆款美食 #神仙吃法 #懒人食谱 等）。
-6. 排版与字数：全文总字数严格控制在 800 字以内。大量使用 emoji 提升阅读体验，段落之间留出空行，保持排版呼吸感。
-7. 格式警告：小红书正文不支持 Markdown 格式！请绝对不要使用 `**加粗**`、`# 标题` 或 `- 列表` 等 Markdown 语法，请仅使用纯文本、换行和 Emoji 进行排版。
+{XHS_POST_REQUIREMENTS}
 
 食谱信息：
 标题：{recipe.title}
 食材：{', '.join(recipe.ingredients)}
 步骤：
-{chr(10).join(recipe.steps)}
+{steps_text}
 
 请严格返回 JSON 格式，包含以下字段：
 - title: 笔记标题 (绝对不能超过18个字)
 - content: 笔记正文
 """
-    completion = await ai_client.chat.completions.create(
+    # 流式接收：文案较长时客户端可以通过进度通知看到生成仍在进行，而不是一直干等
+    stream = await ai_client.chat.completions.create(
         model=MODEL_NAME,
         messages=[
-            {"role": "system", "content": "你是一个熟练掌握小红书爆款文案风格的美食博主，只返回 JSON。"},
+            {"role": "system", "content": XHS_POST_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
-        response_format={"type": "json_object"}
+        response_format={"type": "json_object"},
+        stream=True
     )
-    
-    import json
-    content = completion.choices[0].message.content
+    report_progress = POST_PROGRESS_CALLBACK.get()
+    parts: List[str] = []
+    received = reported = 0
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        parts.append(delta)
+        received += len(delta)
+        if report_progress and received - reported >= POST_PROGRESS_STEP_CHARS:
+            reported = received
+            await report_progress(received)
+
+    content = "".join(parts)
     if content:
-        return json.loads(content)
+        return orjson.loads(content)
     return {"title": recipe.title, "content": "\n".join(recipe.steps)}
 
-async def download_image(url: str, save_dir: str, referer: str = "") -> Optional[str]:
-    """下载图片到本地，支持动态 Referer 以绕过不同网站的防盗链，同时也支持本地图片路径"""
+@async_ttl_cache(maxsize=128, ttl=600, key=normalize_url)
+async def extract_recipe_and_post(url: str) -> Tuple[RecipeData, Dict[str, str]]:
+    """抓取网页并在一次 AI 调用里同时完成食谱提取和小红书文案生成，返回 (食谱数据, 笔记)
+
+    后台发布流程两样都要，合并后少一次串行的 AI 往返。只需要食谱时仍用 extract_recipe_from_url。
+    合并结果缺少文案字段时，再单独调用 generate_xiaohongshu_post 补上。
+    """
+    page = await scrape_recipe_page(url)
+    if not page.text:
+        # 页面没有正文可提取，直接用已解析的结果组装食谱（仍照常探测视频），不必重新抓取
+        _, video_url = await _await_with_video_probe(asyncio.sleep(0), page, url)
+        recipe = RecipeData(
+            title=page.title, ingredients=[], steps=[], image_urls=page.image_urls, video_url=video_url
+        )
+        return recipe, await generate_xiaohongshu_post(recipe)
+
+    prompt = f"""
+请从以下网页文本中提取食谱信息，并翻译为中文；然后根据提取结果，为我生成一篇【有故事性、实用性】的爆款小红书美食笔记。
+如果文本中不包含食谱，请尽力提取主要内容作为步骤。
+
+【笔记要求】
+{XHS_POST_REQUIREMENTS}
+
+网页标题：{page.title}
+网页文本：
+{page.text}
+
+请严格返回 JSON 格式，包含以下字段：
+- ingredients: 字符串数组，包含所需食材的中文翻译
+- steps: 字符串数组，包含制作步骤的中文翻译
+- xhs_title: 笔记标题 (绝对不能超过18个字)
+- xhs_content: 笔记正文
+"""
+    ai_client = get_ai_client()
+    ai_task = ai_client.chat.completions.create(
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": XHS_POST_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        response_format={"type": "json_object"}
+    )
+    completion, video_url = await _await_with_video_probe(ai_task, page, url)
+
+    content = completion.choices[0].message.content
+    data = orjson.loads(content) if content else {}
+    recipe = RecipeData(
+        title=page.title,
+        ingredients=data.get('ingredients', []),
+        steps=data.get('steps', []),
+        image_urls=page.image_urls,
+        video_url=video_url
+    )
+    if data.get('xhs_title') and data.get('xhs_content'):
+        return recipe, {"title": data['xhs_title'], "content": data['xhs_content']}
+    print("合并调用没有返回笔记文案，改为单独生成", file=sys.stderr)
+    return recipe, await generate_xiaohongshu_post(recipe)
+
+# 下载图片时模拟浏览器的固定请求头，Referer 按图片来源单独设置
+IMAGE_REQUEST_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
+    "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+    "Sec-Ch-Ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
+    "Sec-Ch-Ua-Mobile": "?0",
+    "Sec-Ch-Ua-Platform": '"Windows"',
+    "Sec-Fetch-Dest": "image",
+    "Sec-Fetch-Mode": "no-cors",
+    "Sec-Fetch-Site": "cross-site",
+}
+
+# 同时进行的图片下载不超过 4 个，避免一次性把 9 张图的请求全打到源站而触发 429 / Cloudflare 拦截
+IMAGE_DOWNLOAD_SEMAPHORE = asyncio.Semaphore(4)
+
+# 图片下载共用的 HTTP/2 客户端，首次使用时创建，进程退出前由 close_image_client 关闭
+_IMAGE_CLIENT: Optional[httpx.AsyncClient] = None
+
+def get_image_client() -> httpx.AsyncClient:
+    """获取（必要时创建）共享的图片下载客户端，所有图片复用同一组 keep-alive 连接"""
+    global _IMAGE_CLIENT
+    if _IMAGE_CLIENT is None or _IMAGE_CLIENT.is_closed:
+        _IMAGE_CLIENT = httpx.AsyncClient(
+            follow_redirects=True,
+            http2=True,
+            headers=IMAGE_REQUEST_HEADERS,
+            timeout=20,
+            limits=httpx.Limits(max_keepalive_connections=20),
+        )
+    return _IMAGE_CLIENT
+
+async def close_image_client():
+    """关闭共享的图片下载客户端"""
+    global _IMAGE_CLIENT
+    if _IMAGE_CLIENT is not None:
+        await _IMAGE_CLIENT.aclose()
+        _IMAGE_CLIENT = None
+
+async def download_image(url: str, save_dir: str, referer: str = "", client: Optional[httpx.AsyncClient] = None) -> Optional[str]:
+    """下载图片到本地，支持动态 Referer 以绕过不同网站的防盗链，同时也支持本地图片路径
+
+    默认复用模块级的图片下载客户端（同一批图片通常来自同一个 CDN），也可以显式传入 client。
+    """
     try:
         if url.startswith('file://'):
             import shutil
@@ -368,39 +1047,35 @@ async def download_image(url: str, save_dir: str, referer: str = "") -> Optional
             shutil.copy2(url, file_path)
             return file_path
 
-        from urllib.parse import urlparse
         # 动态生成 Referer：使用来源页面的域名，若未指定则从图片 URL 推断
         if not referer:
             parsed = urlparse(url)
             referer = f"{parsed.scheme}://{parsed.netloc}/"
 
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36",
-            "Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-            "Sec-Ch-Ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
-            "Sec-Ch-Ua-Mobile": "?0",
-            "Sec-Ch-Ua-Platform": '"Windows"',
-            "Sec-Fetch-Dest": "image",
-            "Sec-Fetch-Mode": "no-cors",
-            "Sec-Fetch-Site": "cross-site",
-            "Referer": referer
-        }
-        async with httpx.AsyncClient(follow_redirects=True, headers=headers) as client:
-            response = await client.get(url)
+        if client is None:
+            # 共享客户端已带上固定的浏览器请求头，每次只需附加 Referer
+            client = get_image_client()
+            headers = {"Referer": referer}
+        else:
+            headers = {**IMAGE_REQUEST_HEADERS, "Referer": referer}
+        async with IMAGE_DOWNLOAD_SEMAPHORE, client.stream('GET', url, headers=headers) as response:
             response.raise_for_status()
             
-            # 从 URL 获取后缀，默认 jpg
-            ext = url.split('.')[-1][:4] if '.' in url else 'jpg'
-            # 过滤特殊字符
-            ext = re.sub(r'[^a-zA-Z0-9]', '', ext)
-            if ext not in ['jpg', 'jpeg', 'png', 'webp']:
-                 ext = 'jpg'
+            # 优先按 Content-Type 取后缀，识别不了再从 URL 获取，默认 jpg
+            content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+            ext = IMAGE_CONTENT_TYPES.get(content_type)
+            if not ext:
+                ext = url.split('.')[-1][:4] if '.' in url else 'jpg'
+                # 过滤特殊字符
+                ext = EXT_UNSAFE_RE.sub('', ext)
+                if ext not in ['jpg', 'jpeg', 'png', 'webp']:
+                     ext = 'jpg'
                  
+            # 边下载边写盘，不把整张图片缓存在内存里
             file_path = os.path.join(save_dir, f"{uuid.uuid4().hex}.{ext}")
             with open(file_path, 'wb') as f:
-                f.write(response.content)
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
             return file_path
     except Exception as e:
         print(f"下载图片失败 {url}: {e}")
@@ -410,8 +1085,6 @@ async def download_image(url: str, save_dir: str, referer: str = "") -> Optional
 
 async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str], source_url: str = "", video_url: Optional[str] = None, save_draft: bool = False) -> str:
     """将笔记发布到小红书"""
-    from urllib.parse import urlparse
-
     # 从原始页面 URL 提取域名，用于图片下载时的 Referer（绕防盗链）
     image_referer = ""
     if source_url:
@@ -422,15 +1095,29 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
     temp_dir = os.path.join(os.getcwd(), "temp_media")
     os.makedirs(temp_dir, exist_ok=True)
     
+    # 视频模式下封面图的下载任务，与视频下载同时进行
+    cover_task: Optional[asyncio.Future] = None
+    
     try:
         # 优先发布视频
         if video_url:
             print(f"正在准备下载视频: {video_url}")
+            # 封面图和视频来自不同站点、互不依赖，先在后台开始下载最多 3 张封面图
+            if image_urls:
+                print(f"视频模式：后台并发下载最多 3 张封面图...")
+                cover_task = asyncio.ensure_future(asyncio.gather(
+                    *(download_image(url, temp_dir, referer=image_referer) for url in image_urls[:3]),
+                    return_exceptions=True,
+                ))
             video_path = os.path.join(temp_dir, f"{uuid.uuid4().hex}.mp4")
             
             cookie_path = os.path.join(os.getcwd(), 'cookies.txt')
             is_youtube = 'youtube.com' in video_url or 'youtu.be' in video_url
             
+            # 后台发布进程在 POSIX 下没有终端（stdin 是 /dev/null），无法等用户操作时直接降级为图文
+            interactive = sys.stdin is not None and sys.stdin.isatty()
+            skip_video = False
+
             # 针对 YouTube 的交互式 Cookie 提示
             if is_youtube:
                 while True:
@@ -442,11 +1129,18 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
                         print("⚠️ 检测到 YouTube 视频，且当前目录缺少 cookies.txt 文件。")
                         print("👉 请在浏览器中安装 Get cookies.txt 扩展，导出并保存到本项目根目录的 cookies.txt 文件中。")
                         print("!"*50)
-                        input("保存完成后，请按【回车键】继续...")
+                        if not interactive:
+                            print("⏭️ 当前没有可交互的终端，放弃视频，降级为图文模式。")
+                            skip_video = True
+                            break
+                        # 在线程里等待输入，发布进程的事件循环仍能接收和确认新任务
+                        await asyncio.get_running_loop().run_in_executor(
+                            BLOCKING_EXECUTOR, input, "保存完成后，请按【回车键】继续..."
+                        )
             
             # 尝试下载
             download_success = False
-            while not download_success:
+            while not download_success and not skip_video:
                 ydl_opts = {
                     'outtmpl': video_path,
                     'quiet': False, # 关闭 quiet 以便用户能看到 bot 检测错误
@@ -462,7 +1156,6 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
                     ydl_opts['js_engine'] = 'nodejs' # 使用用户提到的 nodejs 绕过
 
                 try:
-                    import subprocess
                     if is_youtube and os.path.exists(cookie_path):
                         # 如果是 YouTube，由于 Python API 内部直接调用有时无法正确挂载 node 环境来解密 JS 挑战
                         # 这里直接采用 subprocess 调用命令行的 yt-dlp 来实现与用户终端一致的行为
@@ -472,47 +1165,45 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
                             '--cookies', cookie_path, 
                             '--js-runtimes', 'node', 
                             '--no-check-certificate',
+                            # 输出到管道时进度之间用 \r 分隔，StreamReader 只按 \n 分行，长下载会攒出超长的一“行”而报错
+                            '--newline',
                             '-o', video_path, 
                             video_url
                         ]
                         
-                        loop = asyncio.get_running_loop()
-                        def run_cmd():
-                            # 使用 errors='replace' 来避免 Windows 平台下的解码报错
-                            process = subprocess.Popen(
-                                cmd, 
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.STDOUT, 
-                                text=True, 
-                                encoding='utf-8', 
-                                errors='replace'
-                            )
-                            for line in process.stdout: # type: ignore
+                        # 直接在事件循环里异步读取子进程输出，不再占用一个线程池线程
+                        process = await asyncio.create_subprocess_exec(
+                            *cmd,
+                            stdout=asyncio.subprocess.PIPE,
+                            stderr=asyncio.subprocess.STDOUT,
+                        )
+                        try:
+                            async for raw_line in process.stdout: # type: ignore
+                                # 使用 errors='replace' 来避免 Windows 平台下的解码报错
+                                line = raw_line.decode('utf-8', errors='replace')
                                 # 将 yt-dlp 的下载进度实时打印出来
                                 if '[download]' in line or '[youtube]' in line:
                                     # 为了不刷屏，只打印部分进度
                                     if 'ETA' in line:
-                                        print(f"\\r{line.strip()}", end='', flush=True)
+                                        print(f"\r{line.strip()}", end='', flush=True)
                                     else:
-                                        print(f"\\n{line.strip()}", flush=True)
-                            process.wait()
-                            print("\\n")
-                            # yt-dlp 返回非 0 即为失败，我们将具体的输出保存起来用于外部捕获关键字
-                            if process.returncode != 0:
-                                return "error_bot_or_signin" # 用一个固定字符串替代数字，让外面更容易识别出这是可能由于 bot 引起的
-                            return process.returncode
-                            
-                        returncode = await loop.run_in_executor(None, run_cmd)
+                                        print(f"\n{line.strip()}", flush=True)
+                            returncode = await process.wait()
+                        finally:
+                            # 读取输出出错或任务被取消时结束 yt-dlp，不留下没人读输出的子进程
+                            if process.returncode is None:
+                                process.kill()
+                                await process.wait()
+                        print("\n")
                         
-                        if returncode == "error_bot_or_signin":
+                        # yt-dlp 返回非 0 即为失败，错误信息里带上关键字，让外面更容易识别出这是可能由于 bot 引起的
+                        if returncode != 0:
                             raise RuntimeError("yt-dlp 执行失败，检测到 bot 或 sign in 相关错误")
-                        elif returncode != 0:
-                            raise RuntimeError(f"yt-dlp 子进程返回错误码: {returncode}")
                     else:
                         loop = asyncio.get_running_loop()
                         await loop.run_in_executor(
-                            None,
-                            lambda: yt_dlp.YoutubeDL(params=ydl_opts).download([video_url]) # type: ignore
+                            BLOCKING_EXECUTOR,
+                            lambda: load_ytdlp().YoutubeDL(params=ydl_opts).download([video_url]) # type: ignore
                         )
                     
                     if os.path.exists(video_path):
@@ -529,7 +1220,12 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
                         print("👉 请重新导出最新的 cookies.txt 文件覆盖原文件。")
                         print("如果想放弃下载该视频转而发布纯图文，请直接关闭本窗口，或者输入 'skip' 并回车。")
                         print("!"*50)
-                        user_input = input("更新 cookies.txt 后按【回车键】重试，或输入 skip 放弃视频：")
+                        if not interactive:
+                            print("⏭️ 当前没有可交互的终端，放弃视频，降级为图文模式。")
+                            break
+                        user_input = await asyncio.get_running_loop().run_in_executor(
+                            BLOCKING_EXECUTOR, input, "更新 cookies.txt 后按【回车键】重试，或输入 skip 放弃视频："
+                        )
                         if user_input.strip().lower() == 'skip':
                             print("⏭️ 用户选择放弃视频，降级为图文模式。")
                             break # 跳出 while 循环
@@ -538,22 +1234,17 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
                         break
 
             if download_success:
-                # 同时并发下载最多 3 张图片作为视频封面图
+                # 等待后台的封面图下载完成
                 cover_image_paths: List[str] = []
-                if image_urls:
-                    print(f"视频模式：并发下载最多 3 张封面图...")
-                    cover_tasks = [
-                        download_image(url, temp_dir, referer=image_referer)
-                        for url in image_urls[:3]
-                    ]
-                    cover_results = await asyncio.gather(*cover_tasks, return_exceptions=True)
+                if cover_task is not None:
+                    cover_results = await cover_task
                     cover_image_paths = [
                         r for r in cover_results
                         if isinstance(r, str) and r
                     ]
                     print(f"封面图下载完成，成功 {len(cover_image_paths)} / {min(len(image_urls), 3)} 张")
 
-                result = await publish_with_playwright(
+                result = await load_publisher().publish_with_playwright(
                     title, content,
                     video_path=video_path,
                     cover_image_paths=cover_image_paths,
@@ -564,12 +1255,14 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
                 print("⚠️ 视频下载失败，已自动降级为图文模式发布...")
 
         # 没有视频则并发下载图片（asyncio.gather 并发，提升速度）
+        # 视频下载失败降级过来时，前 3 张已经作为封面图下载过，直接复用
+        prefetched_results = list(await cover_task) if cover_task is not None else []
         print(f"开始并发下载 {min(len(image_urls), 9)} 张图片...")
         download_tasks = [
             download_image(url, temp_dir, referer=image_referer)
-            for url in image_urls[:9]  # 限制最多 9 张图
+            for url in image_urls[len(prefetched_results):9]  # 限制最多 9 张图
         ]
-        results = await asyncio.gather(*download_tasks, return_exceptions=True)
+        results = prefetched_results + list(await asyncio.gather(*download_tasks, return_exceptions=True))
         local_image_paths = [
             r for r in results
             if isinstance(r, str) and r  # 过滤失败的任务（None 或 Exception）
@@ -586,13 +1279,18 @@ async def publish_to_xiaohongshu(title: str, content: str, image_urls: List[str]
                 raise ValueError("没有成功下载到任何图片或视频，无法发布笔记")
             
         # 使用 Playwright 发布图文
-        result = await publish_with_playwright(title, content, image_paths=local_image_paths, save_draft=save_draft)
+        result = await load_publisher().publish_with_playwright(title, content, image_paths=local_image_paths, save_draft=save_draft)
         return result
         
     finally:
+        # 视频下载阶段出错提前退出时，不再需要的封面图下载一并取消
+        if cover_task is not None and not cover_task.done():
+            cover_task.cancel()
+            # 取消后要等它结束并取走 CancelledError，否则事件循环会报 “exception was never retrieved”
+            with contextlib.suppress(asyncio.CancelledError):
+                await cover_task
         # 延迟清理临时文件，确保 playwright 读取完成
         # 实际上为了排查问题，暂时不清理
-        pass
 
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
@@ -642,51 +1340,27 @@ async def handle_list_tools() -> list[types.Tool]:
         )
     ]
 
-def run_background_publish(url: str, save_draft: bool = False):
-    """在一个独立的进程中运行发布任务，避免阻塞 MCP"""
-    project_root = os.path.dirname(os.path.abspath(__file__))
-    script = f"""
-import asyncio
-import sys
-import os
-import io
-
-# 将项目根目录添加到路径，确保能导入 server 模块
-sys.path.append(r"{project_root}")
-
-from server import extract_recipe_from_url, generate_xiaohongshu_post, publish_to_xiaohongshu
-from dotenv import load_dotenv
+async def run_publish_flow(target_url: str, is_draft: bool = False):
+    """完整的后台发布流程：抓取网页 -> AI 生成文案 -> 下载素材 -> 浏览器发布
 
-# 解决 Windows 下 Emoji 打印导致的编码问题，并设置为行缓冲以防输出卡住
-if hasattr(sys.stdout, 'reconfigure'):
-    sys.stdout.reconfigure(encoding='utf-8', line_buffering=True)
-elif hasattr(sys.stdout, 'buffer'):
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace', line_buffering=True)
-
-load_dotenv()
-
-async def main():
+    运行在独立的发布进程里（见 serve_publish_jobs），输出直接打印到该进程的控制台/日志。
+    浏览器和下载客户端由发布进程统一管理，任务结束后保持打开，供下一个任务复用。
+    """
     try:
-        # 获取命令行参数传入的 URL
-        target_url = sys.argv[1] if len(sys.argv) > 1 else r"{url}"
-        is_draft = sys.argv[2] == "True" if len(sys.argv) > 2 else {"True" if save_draft else "False"}
-        print("\\n" + "="*40, flush=True)
+        print("\n" + "="*40, flush=True)
         print(f"🚀 捕获到新任务！", flush=True)
-        print(f"📍 目标网址: {{target_url}}", flush=True)
-        print("="*40 + "\\n", flush=True)
-        
-        print("🔍 正在抓取并分析网页内容...", flush=True)
-        recipe_data = await extract_recipe_from_url(target_url)
+        print(f"📍 目标网址: {target_url}", flush=True)
+        print("="*40 + "\n", flush=True)
         
-        print("📝 正在使用 AI 生成爆款推文...", flush=True)
-        post_data = await generate_xiaohongshu_post(recipe_data)
+        print("🔍 正在抓取网页，并使用 AI 提取食谱、生成爆款推文...", flush=True)
+        recipe_data, post_data = await extract_recipe_and_post(target_url)
         
-        print(f"✨ 文案生成成功！标题: {{post_data.get('title', '无标题')}}", flush=True)
+        print(f"✨ 文案生成成功！标题: {post_data.get('title', '无标题')}", flush=True)
         
         if recipe_data.video_url:
             print(f"📹 发现视频，准备下载并发布...", flush=True)
         elif recipe_data.image_urls:
-            print(f"🖼️ 发现 {{len(recipe_data.image_urls)}} 张图片，准备下载并发布...", flush=True)
+            print(f"🖼️ 发现 {len(recipe_data.image_urls)} 张图片，准备下载并发布...", flush=True)
             
         print("🌐 正在启动浏览器准备发布...", flush=True)
         
@@ -698,37 +1372,145 @@ async def main():
             video_url=recipe_data.video_url,
             save_draft=is_draft
         )
-        print("\\n================================", flush=True)
+        print("\n================================", flush=True)
         print("✅ 全部流程执行完毕，已成功发布！", flush=True)
         print("================================", flush=True)
     except Exception as _e:
-        print("\\n" + "!"*40, flush=True)
+        print("\n" + "!"*40, flush=True)
         print("❌ 后台执行发生错误件", flush=True)
         print(str(_e), flush=True)
-        print("!"*40 + "\\n", flush=True)
+        print("!"*40 + "\n", flush=True)
         import traceback
         traceback.print_exc()
         # 记录错误到本地文件便于排查
-        error_log_path = os.path.join(r"{project_root}", 'publish_error.log')
+        error_log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'publish_error.log')
         with open(error_log_path, 'w', encoding='utf-8') as f:
             f.write(str(_e))
-            f.write("\\n\\n")
-            traceback.print_report(file=f)
+            f.write("\n\n")
+            traceback.print_exc(file=f)
+
+@functools.lru_cache(maxsize=None)
+def get_publish_worker_key() -> bytes:
+    """读取发布进程的通信密钥，不存在时生成一个（权限 0600）"""
+    os.makedirs(os.path.dirname(PUBLISH_WORKER_KEY_PATH), exist_ok=True)
+    try:
+        fd = os.open(PUBLISH_WORKER_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        if os.name != 'nt' and os.stat(PUBLISH_WORKER_KEY_PATH).st_mode & 0o077:
+            os.chmod(PUBLISH_WORKER_KEY_PATH, 0o600)
+        with open(PUBLISH_WORKER_KEY_PATH, 'rb') as f:
+            return f.read().strip()
+    key = secrets.token_hex(32).encode('ascii')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+def sign_publish_message(payload: bytes) -> bytes:
+    """用通信密钥给任务或确认消息签名；密钥本身从不经过 socket 发送"""
+    return hmac.new(get_publish_worker_key(), payload, 'sha256').hexdigest().encode('ascii')
+
+async def serve_publish_jobs(first_job: Optional[Dict[str, Any]] = None):
+    """常驻的后台发布进程：监听本机端口接收发布任务，按顺序逐个执行
+
+    浏览器（BrowserPool）在多个任务之间保持打开，后续发布省去 Python 冷启动和 Chromium 启动的时间；
+    空闲 PUBLISH_WORKER_IDLE_SECONDS 秒后关闭浏览器并退出。能否绑定端口同时充当单实例锁：
+    绑定失败说明已有发布进程在运行，把自己的任务转交给它即可。
+    每个任务都要带上用 PUBLISH_WORKER_KEY_PATH 密钥生成的签名，签名不对的直接丢弃。
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    # 已收到的任务 ID：确认回得太晚、发送方重新投递时不会重复发布
+    received_ids: set = set()
+
+    async def accept_job(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            signature, _, payload = (await reader.readline()).strip().partition(b" ")
+            if not hmac.compare_digest(signature, sign_publish_message(payload)):
+                print("⚠️ 收到签名不正确的任务，已忽略", flush=True)
+                return
+            job = orjson.loads(payload)
+            job_id = str(job.get("id", ""))
+            if job_id not in received_ids:
+                received_ids.add(job_id)
+                queue.put_nowait(job)
+                print(f"📥 收到新任务，当前排队 {queue.qsize()} 个", flush=True)
+            writer.write(sign_publish_message(b"ack:" + job_id.encode()) + b"\n")
+            await writer.drain()
+        except Exception as e:
+            print(f"接收任务失败: {e}", flush=True)
+        finally:
+            writer.close()
+
+    try:
+        listener = await asyncio.start_server(accept_job, "127.0.0.1", PUBLISH_WORKER_PORT)
+    except OSError:
+        if first_job and not await send_publish_job(first_job):
+            print("❌ 发布进程端口被占用，且无法把任务转交给已运行的发布进程", flush=True)
+        return
+
+    if first_job:
+        received_ids.add(str(first_job.get("id", "")))
+        queue.put_nowait(first_job)
+    try:
+        while True:
+            try:
+                job = await asyncio.wait_for(queue.get(), timeout=PUBLISH_WORKER_IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                break
+            await run_publish_flow(job["url"], is_draft=bool(job.get("save_draft")))
+            print(f"\n💤 等待下一个任务（空闲 {PUBLISH_WORKER_IDLE_SECONDS // 60} 分钟后自动退出）...", flush=True)
     finally:
-        print("\\n⏳ 本控制台将在 30 秒后自动关闭...", flush=True)
+        listener.close()
+        # 停止监听后，处理掉关闭前刚收到的任务再退出
+        while not queue.empty():
+            job = queue.get_nowait()
+            await run_publish_flow(job["url"], is_draft=bool(job.get("save_draft")))
+        await load_publisher().browser_pool.close()
+        await close_image_client()
+        await close_page_client()
+        shutdown_parse_pool()
+        print("\n⏳ 本控制台将在 30 秒后自动关闭...", flush=True)
         await asyncio.sleep(30)
 
-if __name__ == '__main__':
-    asyncio.run(main())
-"""
-    # 写入临时脚本并执行
-    import tempfile
-    with tempfile.NamedTemporaryFile('w', delete=False, suffix='.py', encoding='utf-8') as f:
-        f.write(script)
-        temp_script_path = f.name
+async def send_publish_job(job: Dict[str, Any], timeout: float = 2.0) -> bool:
+    """把任务交给已在运行的发布进程；只有收到签名正确的确认才返回 True
+
+    没有发布进程在监听、端口被其他程序占用、发布进程正在退出而没有确认，都返回 False，由调用方另起发布进程。
+    """
+    job = {**job, "id": job.get("id") or uuid.uuid4().hex}
+    payload = orjson.dumps(job)
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection("127.0.0.1", PUBLISH_WORKER_PORT), timeout
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        writer.write(sign_publish_message(payload) + b" " + payload + b"\n")
+        await writer.drain()
+        ack = await asyncio.wait_for(reader.readline(), timeout)
+        return hmac.compare_digest(ack.strip(), sign_publish_message(b"ack:" + job["id"].encode()))
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+async def run_background_publish(url: str, save_draft: bool = False) -> Optional[str]:
+    """在独立的发布进程中运行发布任务，避免阻塞 MCP
+
+    发布流程会大量 print，并可能用 input() 等待用户操作；MCP 的 stdio 传输占用了本进程的
+    stdin/stdout，所以不能在当前事件循环里直接跑。优先把任务交给已在运行的发布进程（复用已打开的浏览器），
+    没有时再以 `server.py --publish-worker` 启动一个。POSIX 下返回发布日志的路径。
+    """
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    script_path = os.path.abspath(__file__)
+    log_path = None if os.name == 'nt' else os.path.join(project_root, "temp_media", "publish-worker.log")
+
+    # 任务 ID 同时传给新启动的发布进程：先前没确认的那次投递如果其实已被收到，不会被发布两次
+    job_id = uuid.uuid4().hex
+    if await send_publish_job({"url": url, "save_draft": save_draft, "id": job_id}):
+        return log_path
         
     # 在后台启动进程，通过命令行传参 URL，并指定工作目录
-    import subprocess
     env = os.environ.copy()
     env["PYTHONPATH"] = project_root
     env["PYTHONUNBUFFERED"] = "1"  # 强制彻底关闭 Python 的输出缓冲
@@ -736,7 +1518,7 @@ if __name__ == '__main__':
     if os.name == 'nt': # Windows
         # 针对 Windows 路径带空格的情况，手动构造命令字符串并作为单一字符串传入
         # 避免 subprocess.Popen 列表传参时自动转义双引号
-        command = f'cmd /k "chcp 65001 >nul & "{sys.executable}" "{temp_script_path}" "{url}" "{save_draft}""'
+        command = f'cmd /k "chcp 65001 >nul & "{sys.executable}" "{script_path}" --publish-worker "{url}" "{save_draft}" "{job_id}""'
         subprocess.Popen(
             command, 
             creationflags=subprocess.CREATE_NEW_CONSOLE,
@@ -744,85 +1526,167 @@ if __name__ == '__main__':
             env=env
         )
     else:
-        subprocess.Popen(
-            [sys.executable, temp_script_path, url, str(save_draft)], 
-            start_new_session=True,
-            cwd=project_root,
-            env=env
-        )
-
-@server.call_tool()
-async def handle_call_tool(name: str, arguments: dict | None) -> list[types.TextContent | types.ImageContent | types.EmbeddedResource]:
-    """Handle tool execution requests."""
-    if not arguments:
-        raise ValueError("Missing arguments")
+        # 没有新控制台可弹，输出追加到日志文件，可以用 tail -f 查看进度；
+        # 不能继承 MCP 的 stdin/stdout，否则会读走或污染协议数据
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with open(log_path, 'ab') as log_file:
+            subprocess.Popen(
+                [sys.executable, script_path, "--publish-worker", url, str(save_draft), job_id], 
+                start_new_session=True,
+                cwd=project_root,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+            )
+    return log_path
 
-    if name in ["generate_and_publish_recipe", "generate_and_save_draft_recipe"]:
-        url = arguments.get("url")
-        if not url:
-            raise ValueError("Missing url parameter")
-            
-        is_draft = (name == "generate_and_save_draft_recipe")
-        try:
-            # 改为异步触发，立刻返回给客户端
-            run_background_publish(url, save_draft=is_draft)
-            
-            action_text = "存草稿（暂存离开）" if is_draft else "发布"
-            return [types.TextContent(
-                type="text",
-                text=f"✅ {action_text}任务已在后台启动！\n\n请注意你的桌面，稍后会自动弹出一个浏览器窗口。\n如果是首次运行，请在弹出的浏览器中用手机扫码登录小红书。"
-            )]
-        except Exception as e:
-            return [types.TextContent(type="text", text=f"后台任务启动失败: {str(e)}")]
-            
-    elif name == "draft_recipe_note":
-         url = arguments.get("url")
-         if not url:
-             raise ValueError("Missing url parameter")
-             
-         try:
-            # 1. 抓取网页并提取结构化数据
-            recipe_data = await extract_recipe_from_url(url)
-            
-            # 2. 生成文案
-            post_data = await generate_xiaohongshu_post(recipe_data)
-            
-            result = f"""
+# draft_recipe_note 返回给客户端的草稿模板
+DRAFT_RESULT_TEMPLATE = """
 ## 生成的笔记草稿
 
 ### 标题
-{post_data['title']}
+{title}
 
 ### 正文
-{post_data['content']}
+{content}
 
 ### 提取的视频链接
-{recipe_data.video_url if recipe_data.video_url else '未找到视频'}
+{video}
 
 ### 提取的图片链接 (前9张)
-{chr(10).join(recipe_data.image_urls[:9])}
+{images}
 """
-            return [types.TextContent(type="text", text=result)]
-         except Exception as e:
-            return [types.TextContent(type="text", text=f"执行草稿生成失败: {str(e)}")]
 
-    raise ValueError(f"Unknown tool: {name}")
+# 工具调用中预期可能出现的错误（网络、AI 接口、超时、文件读写、返回数据格式不对），转成文字回复给客户端；
+# 其他异常属于程序缺陷，交给 MCP 框架按工具错误返回，不在这里吞掉
+PUBLISH_START_ERRORS = (OSError, subprocess.SubprocessError)
+DRAFT_ERRORS = (httpx.HTTPError, OpenAIError, asyncio.TimeoutError, OSError, ValueError, LookupError)
+
+def require_url(arguments: dict) -> str:
+    """取出工具参数里的 url，缺失、不是字符串或为空时抛出 ValueError"""
+    url = arguments.get("url")
+    if url is None:
+        raise ValueError("Missing url parameter")
+    if not isinstance(url, str):
+        raise ValueError(f"url must be a string, got {type(url).__name__}")
+    url = url.strip()
+    if not url:
+        raise ValueError("url parameter is empty")
+    return url
+
+async def handle_background_publish(arguments: dict, save_draft: bool) -> list[types.TextContent]:
+    """generate_and_publish_recipe / generate_and_save_draft_recipe：把发布任务交给后台发布进程"""
+    url = require_url(arguments)
+
+    try:
+        # 改为异步触发，立刻返回给客户端
+        log_path = await run_background_publish(url, save_draft=save_draft)
+
+        action_text = "存草稿（暂存离开）" if save_draft else "发布"
+        log_hint = f"\n进度日志: {log_path}" if log_path else ""
+        return [types.TextContent(
+            type="text",
+            text=f"✅ {action_text}任务已在后台启动！\n\n请注意你的桌面，稍后会自动弹出一个浏览器窗口。\n如果是首次运行，请在弹出的浏览器中用手机扫码登录小红书。{log_hint}"
+        )]
+    except PUBLISH_START_ERRORS as e:
+        return [types.TextContent(type="text", text=f"后台任务启动失败: {e!r}")]
+
+async def handle_draft_recipe_note(arguments: dict) -> list[types.TextContent]:
+    """draft_recipe_note：抓取网页并生成笔记草稿，直接返回给客户端预览"""
+    url = require_url(arguments)
+
+    try:
+        # 1. 抓取网页并提取结构化数据
+        recipe_data = await extract_recipe_from_url(url)
+
+        # 2. 生成文案；客户端带了 progressToken 时，流式生成过程中发送进度通知
+        ctx = server.request_context
+        progress_token = ctx.meta.progressToken if ctx.meta else None
+        callback_token = None
+        if progress_token is not None:
+            async def report_progress(chars: int):
+                await ctx.session.send_progress_notification(progress_token, chars)
+            callback_token = POST_PROGRESS_CALLBACK.set(report_progress)
+        try:
+            post_data = await generate_xiaohongshu_post(recipe_data)
+        finally:
+            if callback_token is not None:
+                POST_PROGRESS_CALLBACK.reset(callback_token)
+
+        result = DRAFT_RESULT_TEMPLATE.format_map({
+            "title": post_data['title'],
+            "content": post_data['content'],
+            "video": recipe_data.video_url or '未找到视频',
+            "images": recipe_data.image_urls_preview,
+        })
+        return [types.TextContent(type="text", text=result)]
+    except DRAFT_ERRORS as e:
+        return [types.TextContent(type="text", text=f"执行草稿生成失败: {e!r}")]
+
+# 工具名 -> 处理函数，新增工具时在这里登记
+TOOL_HANDLERS: Dict[str, Callable[[dict], Awaitable[list]]] = {
+    "generate_and_publish_recipe": functools.partial(handle_background_publish, save_draft=False),
+    "generate_and_save_draft_recipe": functools.partial(handle_background_publish, save_draft=True),
+    "draft_recipe_note": handle_draft_recipe_note,
+}
+
+@server.call_tool()
+async def handle_call_tool(name: str, arguments: dict | None) -> list[types.TextContent | types.ImageContent | types.EmbeddedResource]:
+    """Handle tool execution requests."""
+    if not arguments:
+        raise ValueError("Missing arguments")
+
+    handler = TOOL_HANDLERS.get(name)
+    if handler is None:
+        raise ValueError(f"Unknown tool: {name}")
+    return await handler(arguments)
+
+def log_unhandled_exception(loop: asyncio.AbstractEventLoop, context: Dict[str, Any]):
+    """后台任务里没人取走的异常统一打到 stderr（stdout 是 MCP 的传输通道，不能写）"""
+    exc = context.get("exception")
+    print(f"未处理的异步异常: {context.get('message', '')} {exc!r}", file=sys.stderr)
+    if exc is not None:
+        import traceback
+        traceback.print_exception(type(exc), exc, exc.__traceback__, file=sys.stderr)
 
 async def main():
+    asyncio.get_running_loop().set_exception_handler(log_unhandled_exception)
+    # 启动时就在后台加载 tiktoken 编码表（下载到磁盘缓存），解析进程和线程池里的兜底解析都不必等它下载
+    start_token_encoder_load()
     # Run the server using stdin/stdout streams
-    async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="xiaohongshu-recipe",
-                server_version="0.1.0",
-                capabilities=server.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={},
+    try:
+        async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="xiaohongshu-recipe",
+                    server_version="0.1.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={},
+                    ),
                 ),
-            ),
-        )
+            )
+    finally:
+        await close_image_client()
+        await close_page_client()
+        shutdown_parse_pool()
+
+def run_event_loop(coro):
+    """运行顶层协程：装了 uvloop 就用 uvloop 的事件循环，否则用 asyncio 默认循环"""
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if len(sys.argv) > 2 and sys.argv[1] == "--publish-worker":
+        # 由 run_background_publish 启动的常驻发布进程，命令行带着第一个任务
+        run_event_loop(serve_publish_jobs({
+            "url": sys.argv[2],
+            "save_draft": len(sys.argv) > 3 and sys.argv[3] == "True",
+            "id": sys.argv[4] if len(sys.argv) > 4 else uuid.uuid4().hex,
+        }))
+    else:
+        run_event_loop(main())
\ No newline at end of file